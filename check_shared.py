@@ -0,0 +1,52 @@
+"""Fails if the modules shared by tax_automator/ and telegram-bot/ have drifted.
+
+Each service is built from its own directory, so the shared modules and
+their data files live in both. deploy.ps1 runs this before building either
+image:
+
+    python check_shared.py
+"""
+
+import difflib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVICES = ("tax_automator", "telegram-bot")
+SHARED = (
+    "categorizer.py",
+    "tax_rules.json",
+    "extraction_cache.py",
+    "fingerprint.py",
+    "image_prep.py",
+    "query_cache.py",
+    "rollups.py",
+    "vendors.py",
+    "vendor_aliases.json",
+)
+
+
+def read(service: str, name: str) -> list:
+    with open(os.path.join(ROOT, service, name), encoding="utf-8") as f:
+        return f.readlines()
+
+
+def main() -> int:
+    first, second = SERVICES
+    drifted = 0
+    for name in SHARED:
+        diff = list(difflib.unified_diff(
+            read(first, name), read(second, name), f"{first}/{name}", f"{second}/{name}",
+        ))
+        if diff:
+            drifted += 1
+            sys.stdout.writelines(diff)
+    if drifted:
+        print(f"\n{drifted} shared file(s) differ between {first}/ and {second}/", file=sys.stderr)
+        return 1
+    print(f"All {len(SHARED)} shared files match")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,10 @@
 $PROJECT_ID = "blue-hills-tax-automator"
 $REGION = "us-central1"
 
+# Both services carry copies of the shared modules; refuse to deploy drifted ones
+python check_shared.py
+if ($LASTEXITCODE -ne 0) { exit 1 }
+
 # 1. Deploy Tax Automator Agent
 Write-Host "🚀 Deploying Tax Automator Agent..." -ForegroundColor Cyan
 cd tax_automator
@@ -13,6 +17,7 @@ gcloud run deploy tax-automator-agent `
     --platform managed `
     --region $REGION `
     --allow-unauthenticated `
+    --no-cpu-throttling `
     --set-env-vars "GOOGLE_CLOUD_PROJECT=$PROJECT_ID"
 cd ..
 
@@ -25,6 +30,7 @@ gcloud run deploy telegram-bot `
     --platform managed `
     --region $REGION `
     --allow-unauthenticated `
+    --no-cpu-throttling `
     --set-env-vars "GOOGLE_CLOUD_PROJECT=$PROJECT_ID"
 cd ..
 
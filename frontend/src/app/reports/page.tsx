@@ -6,6 +6,17 @@ import { subscribeToReceipts, type Receipt } from "@/lib/firestore";
 import StatusBadge from "@/components/StatusBadge";
 import { useAuth } from "@/components/AuthProvider";
 
+const EXPORT_API_URL = process.env.NEXT_PUBLIC_TAX_AUTOMATOR_URL;
+
+function download(blob: Blob, extension: string) {
+    const url = URL.createObjectURL(blob);
+    const a = document.createElement("a");
+    a.href = url;
+    a.download = `tax-receipts-${new Date().toISOString().slice(0, 10)}.${extension}`;
+    a.click();
+    URL.revokeObjectURL(url);
+}
+
 export default function ReportsPage() {
     const { user } = useAuth();
     const [receipts, setReceipts] = useState<Receipt[]>([]);
@@ -35,7 +46,21 @@ export default function ReportsPage() {
         {}
     );
 
-    const exportCSV = () => {
+    const exportCSV = async () => {
+        // Prefer the streaming server-side export, which pages through Firestore
+        // instead of needing every receipt loaded here first
+        if (EXPORT_API_URL && user) {
+            const token = await user.getIdToken();
+            const res = await fetch(`${EXPORT_API_URL}/export?format=csv&status=completed`, {
+                headers: { Authorization: `Bearer ${token}` },
+            });
+            if (res.ok) {
+                download(await res.blob(), "csv");
+                return;
+            }
+            console.error("Server export failed:", res.status);
+        }
+
         const headers = ["ID", "Store", "Date", "Amount", "Category", "Status"];
         const rows = completed.map((r) => [
             r.id,
@@ -47,13 +72,7 @@ export default function ReportsPage() {
         ]);
 
         const csv = [headers, ...rows].map((row) => row.join(",")).join("\n");
-        const blob = new Blob([csv], { type: "text/csv" });
-        const url = URL.createObjectURL(blob);
-        const a = document.createElement("a");
-        a.href = url;
-        a.download = `tax-receipts-${new Date().toISOString().slice(0, 10)}.csv`;
-        a.click();
-        URL.revokeObjectURL(url);
+        download(new Blob([csv], { type: "text/csv" }), "csv");
     };
 
     return (
@@ -103,33 +103,68 @@ export function subscribeToReceiptsByStatus(
     });
 }
 
+interface CategoryRollup {
+    total: number;
+    count: number;
+}
+
+interface SpendingRollup {
+    month: string;
+    total: number;
+    count: number;
+    categories?: Record<string, CategoryRollup>;
+    days?: Record<string, Record<string, CategoryRollup>>;
+}
+
+/**
+ * Builds a spending summary from the per-month rollups maintained by the
+ * backend (see rollups.py), so only one document per month is read.
+ */
 export async function getSpendingSummary(userId: string, startDate?: string, endDate?: string) {
     let q = query(
-        collection(db, "receipts"),
+        collection(db, "spending_rollups"),
         where("user_id", "==", userId)
     );
     if (startDate) {
-        q = query(q, where("date", ">=", startDate));
+        q = query(q, where("month", ">=", startDate.slice(0, 7)));
     }
     if (endDate) {
-        q = query(q, where("date", "<=", endDate));
+        q = query(q, where("month", "<=", endDate.slice(0, 7)));
     }
     const snapshot = await getDocs(q);
-    const receipts = snapshot.docs.map(doc => docToReceipt(doc.id, doc.data()));
 
     let total = 0;
+    let count = 0;
     const byCategory: Record<string, number> = {};
-    for (const r of receipts) {
-        if (r.amount) {
-            total += r.amount;
-            const cat = r.category || "Uncategorized";
-            byCategory[cat] = (byCategory[cat] || 0) + r.amount;
+    const add = (category: string, stats: CategoryRollup) => {
+        total += stats.total || 0;
+        count += stats.count || 0;
+        byCategory[category] = (byCategory[category] || 0) + (stats.total || 0);
+    };
+
+    for (const d of snapshot.docs) {
+        const rollup = d.data() as SpendingRollup;
+        const wholeMonth =
+            (!startDate || startDate <= `${rollup.month}-01`) &&
+            (!endDate || endDate >= `${rollup.month}-31`);
+        if (wholeMonth) {
+            for (const [category, stats] of Object.entries(rollup.categories ?? {})) {
+                add(category, stats);
+            }
+            continue;
+        }
+        for (const [day, categories] of Object.entries(rollup.days ?? {})) {
+            const date = `${rollup.month}-${day}`;
+            if ((startDate && date < startDate) || (endDate && date > endDate)) continue;
+            for (const [category, stats] of Object.entries(categories)) {
+                add(category, stats);
+            }
         }
     }
     return {
-        total_spent: total,
+        total_spent: Math.round(total * 100) / 100,
         by_category: byCategory,
-        receipt_count: receipts.length
+        receipt_count: count
     };
 }
 
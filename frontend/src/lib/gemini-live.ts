@@ -70,6 +70,7 @@ export class GeminiLiveClient {
     private ws: WebSocket | null = null;
     private config: GeminiLiveConfig;
     private _connected = false;
+    private decoder = new TextDecoder();
 
     // callbacks
     onMessage: (msg: LiveMessage) => void = () => { };
@@ -87,6 +88,7 @@ export class GeminiLiveClient {
 
     connect() {
         this.ws = new WebSocket(this.config.proxyUrl);
+        this.ws.binaryType = "arraybuffer";
 
         this.ws.onopen = () => {
             this._connected = true;
@@ -94,7 +96,8 @@ export class GeminiLiveClient {
             const modelUri = `projects/${this.config.projectId}/locations/us-central1/publishers/google/models/${this.config.model}`;
             const serviceUrl = `wss://us-central1-aiplatform.googleapis.com/ws/google.cloud.aiplatform.v1beta1.LlmBidiService/BidiGenerateContent`;
 
-            this.send({ service_url: serviceUrl });
+            // passthrough: Gemini's binary frames are relayed as-is instead of re-encoded as text
+            this.send({ service_url: serviceUrl, passthrough: true });
 
             // Second message: session setup
             this.send({
@@ -167,7 +170,8 @@ export class GeminiLiveClient {
 
         this.ws.onmessage = (evt) => {
             try {
-                const data = JSON.parse(evt.data);
+                const text = typeof evt.data === "string" ? evt.data : this.decoder.decode(evt.data);
+                const data = JSON.parse(text);
                 const msg = parseResponse(data);
                 this.onMessage(msg);
             } catch (e) {
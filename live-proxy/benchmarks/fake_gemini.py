@@ -0,0 +1,104 @@
+"""Local stand-in for the Gemini Live BidiGenerateContent endpoint.
+
+Accepts any connection and, like Gemini, answers with binary frames.
+- echo: every frame received is sent back, after `latency` seconds.
+- audio_chunk_ms: from the first message on, model audio is streamed back
+  continuously in chunks of that length (24 kHz PCM, as Gemini returns).
+
+Streamed chunks end with a "benchTs" field holding time.perf_counter() at
+send time, so clients in the same process can measure relay latency.
+
+    python benchmarks/fake_gemini.py --port 9001 [--latency-ms 50] [--audio-chunk-ms 40]
+
+then point the proxy's setup message at ws://127.0.0.1:9001. The proxy must
+be started with PROXY_ALLOW_INSECURE_UPSTREAM=1 to accept a ws:// upstream.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import time
+
+import websockets
+
+OUTPUT_RATE = 24000
+
+
+def output_audio_prefix(chunk_ms: int) -> bytes:
+    pcm = os.urandom(OUTPUT_RATE * 2 * chunk_ms // 1000)
+    return (
+        b'{"serverContent":{"modelTurn":{"parts":[{"inlineData":'
+        b'{"mimeType":"audio/pcm;rate=24000","data":"' + base64.b64encode(pcm) + b'"}}]}},"benchTs":'
+    )
+
+
+class FakeGemini:
+    def __init__(self, echo: bool = True, latency: float = 0.0, audio_chunk_ms: int = 0):
+        self.echo = echo
+        self.latency = latency
+        self.audio_chunk_ms = audio_chunk_ms
+        self._audio_prefix = output_audio_prefix(audio_chunk_ms) if audio_chunk_ms else None
+        self.connections = 0
+        self.received = 0
+
+    async def _send_later(self, ws, frame: bytes):
+        await asyncio.sleep(self.latency)
+        try:
+            await ws.send(frame)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _stream_audio(self, ws):
+        interval = self.audio_chunk_ms / 1000
+        next_at = time.perf_counter()
+        while True:
+            next_at += interval
+            await ws.send(self._audio_prefix + b"%.6f}" % time.perf_counter())
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+
+    async def handler(self, ws):
+        self.connections += 1
+        streamer = None
+        try:
+            async for message in ws:
+                self.received += 1
+                if self._audio_prefix and streamer is None:
+                    streamer = asyncio.create_task(self._stream_audio(ws))
+                if not self.echo:
+                    continue
+                frame = message.encode() if isinstance(message, str) else message
+                if self.latency:
+                    asyncio.create_task(self._send_later(ws, frame))
+                else:
+                    await ws.send(frame)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if streamer:
+                streamer.cancel()
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0):
+        """Returns the websockets server; use it as an async context manager."""
+        return websockets.serve(self.handler, host, port, max_size=None)
+
+
+async def _main(args):
+    fake = FakeGemini(not args.no_echo, args.latency_ms / 1000, args.audio_chunk_ms)
+    async with fake.serve(args.host, args.port):
+        print(f"Fake Gemini Live listening on ws://{args.host}:{args.port}")
+        await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--no-echo", action="store_true")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--audio-chunk-ms", type=int, default=0)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
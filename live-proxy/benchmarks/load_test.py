@@ -0,0 +1,279 @@
+"""How many concurrent live sessions one proxy instance sustains.
+
+For each step in --steps, a fresh server.py subprocess is started and
+pointed at a local FakeGemini. Then that many simulated browser clients
+stream through it in real time for --duration seconds. Traffic matches
+the web app: a 4096-sample 16 kHz PCM chunk every 256 ms and a JPEG
+frame every second, all base64 JSON. The fake echoes every frame after
+--latency-ms and can also stream model audio back (--audio-chunk-ms).
+
+Per step it reports:
+- round-trip relay latency percentiles for echoed audio, with the fake's
+  own latency removed, so this is two hops through the proxy
+- one-hop latency for streamed model audio
+- proxy CPU per session, as a percentage of one core
+- proxy memory per session, as peak RSS above the idle process
+- lost audio and dropped video
+
+The saturation point is the first step whose p99 latency, audio loss or
+CPU goes past the limits below.
+
+    python benchmarks/load_test.py [--steps 1,10,25,50,100] [--duration 20]
+    python benchmarks/load_test.py --steps 1,4 --duration 3   # smoke run
+
+Only loopback connections are used, so it needs no credentials or
+network access. Proxy CPU and memory are read from /proc, so Linux only.
+The clients and the fake run in this process; at high session counts,
+check its own CPU is not the bottleneck.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGemini  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+AUDIO_INTERVAL = 4096 / 16000
+VIDEO_INTERVAL = 1.0
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+SETUP = json.dumps({"setup": {
+    "model": "projects/benchmark/locations/us-central1/publishers/google/models/fake",
+    "generation_config": {"response_modalities": ["AUDIO"]},
+}})
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def media_message(mime_type: str, size: int) -> bytes:
+    """Returns a realtime_input prefix; callers append the timestamp and `}`."""
+    data = base64.b64encode(os.urandom(size))
+    return (
+        b'{"realtime_input":{"media_chunks":[{"mime_type":"' + mime_type.encode()
+        + b'","data":"' + data + b'"}]},"benchTs":'
+    )
+
+
+def bench_ts(frame) -> float:
+    if isinstance(frame, str):
+        frame = frame.encode()
+    return float(frame.rsplit(b'"benchTs":', 1)[1][:-1])
+
+
+def proc_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def proc_rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Step:
+    """Counters shared by every client of one step."""
+
+    def __init__(self):
+        self.echo_ms = []
+        self.downlink_ms = []
+        self.audio_sent = 0
+        self.audio_echoed = 0
+        self.video_sent = 0
+        self.video_echoed = 0
+        self.failed = 0
+
+
+async def client(proxy_url: str, upstream_url: str, args, step: Step, audio: bytes, video: bytes):
+    latency = args.latency_ms / 1000
+    try:
+        async with websockets.connect(proxy_url, max_size=None) as ws:
+            await ws.send(json.dumps({
+                "bearer_token": "benchmark",
+                "service_url": upstream_url,
+                "passthrough": not args.text_mode,
+            }))
+            await ws.send(SETUP)
+
+            async def receive():
+                async for frame in ws:
+                    now = time.perf_counter()
+                    # Text mode turns Gemini's binary frames into text
+                    head = frame[:80] if isinstance(frame, bytes) else frame[:80].encode()
+                    if b"serverContent" in head:
+                        step.downlink_ms.append((now - bench_ts(frame)) * 1000)
+                    elif b"image/" in head:
+                        step.video_echoed += 1
+                    elif b"audio/" in head:
+                        step.audio_echoed += 1
+                        step.echo_ms.append((now - bench_ts(frame) - latency) * 1000)
+
+            receiver = asyncio.create_task(receive())
+            # Spread clients over one audio period, as real users would be
+            await asyncio.sleep(random.uniform(0, AUDIO_INTERVAL))
+            start = time.perf_counter()
+            next_audio = next_video = start
+            while time.perf_counter() - start < args.duration:
+                now = time.perf_counter()
+                if now >= next_video:
+                    await ws.send((video + b"%.6f}" % time.perf_counter()).decode())
+                    step.video_sent += 1
+                    next_video += VIDEO_INTERVAL
+                if now >= next_audio:
+                    await ws.send((audio + b"%.6f}" % time.perf_counter()).decode())
+                    step.audio_sent += 1
+                    next_audio += AUDIO_INTERVAL
+                await asyncio.sleep(max(0.0, min(next_audio, next_video) - time.perf_counter()))
+
+            # Let in-flight echoes arrive before hanging up
+            await asyncio.sleep(1.0 + latency)
+            receiver.cancel()
+    except Exception as e:
+        step.failed += 1
+        print(f"  client failed: {e!r}")
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"proxy did not start on port {port}")
+
+
+async def run_step(sessions: int, args) -> dict:
+    upstream_port, proxy_port = free_port(), free_port()
+    fake = FakeGemini(echo=True, latency=args.latency_ms / 1000, audio_chunk_ms=args.audio_chunk_ms)
+    audio = media_message("audio/pcm", 4096 * 2)
+    video = media_message("image/jpeg", args.frame_kb * 1024)
+    step = Step()
+
+    async with fake.serve("127.0.0.1", upstream_port):
+        proc = subprocess.Popen(
+            [sys.executable, SERVER],
+            env={**os.environ, "PORT": str(proxy_port), "PROXY_ALLOW_INSECURE_UPSTREAM": "1"},
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            await wait_for_port(proxy_port)
+            await asyncio.sleep(0.5)
+            idle_rss = proc_rss_bytes(proc.pid)
+            cpu_before = proc_cpu_seconds(proc.pid)
+            peak_rss = idle_rss
+
+            clients = asyncio.gather(*(
+                client(
+                    f"ws://127.0.0.1:{proxy_port}/ws", f"ws://127.0.0.1:{upstream_port}",
+                    args, step, audio, video,
+                )
+                for _ in range(sessions)
+            ))
+            start = time.perf_counter()
+            while not clients.done():
+                peak_rss = max(peak_rss, proc_rss_bytes(proc.pid))
+                await asyncio.wait([clients], timeout=0.25)
+            elapsed = time.perf_counter() - start
+            cpu = proc_cpu_seconds(proc.pid) - cpu_before
+        finally:
+            proc.send_signal(signal.SIGINT)
+            proc.wait()
+
+    audio_lost = step.audio_sent - step.audio_echoed
+    return {
+        "sessions": sessions,
+        "failed": step.failed,
+        "p50_ms": percentile(step.echo_ms, 50),
+        "p95_ms": percentile(step.echo_ms, 95),
+        "p99_ms": percentile(step.echo_ms, 99),
+        "downlink_p99_ms": percentile(step.downlink_ms, 99),
+        "cpu_pct_per_session": cpu / elapsed / sessions * 100,
+        "cpu_pct_total": cpu / elapsed * 100,
+        "mem_kb_per_session": (peak_rss - idle_rss) / sessions / 1024,
+        "audio_loss_pct": audio_lost / step.audio_sent * 100 if step.audio_sent else 0.0,
+        "video_dropped": step.video_sent - step.video_echoed,
+    }
+
+
+def saturated(result: dict, args) -> bool:
+    return (
+        result["failed"] > 0
+        or result["p99_ms"] > args.max_p99_ms
+        or result["audio_loss_pct"] > args.max_audio_loss_pct
+        or result["cpu_pct_total"] > args.max_cpu_pct
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--steps", default="1,10,25,50,100", help="comma-separated session counts")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of streaming per step")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake Gemini response latency")
+    parser.add_argument("--audio-chunk-ms", type=int, default=40, help="model audio cadence, 0 to disable")
+    parser.add_argument("--frame-kb", type=int, default=40, help="JPEG frame size")
+    parser.add_argument("--text-mode", action="store_true", help="disable passthrough")
+    parser.add_argument("--max-p99-ms", type=float, default=250.0)
+    parser.add_argument("--max-audio-loss-pct", type=float, default=0.5)
+    parser.add_argument("--max-cpu-pct", type=float, default=90.0)
+    args = parser.parse_args()
+
+    print(
+        f"{'sessions':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'down p99':>10}"
+        f"{'cpu%/sess':>11}{'cpu% tot':>10}{'KB/sess':>9}{'aud loss%':>11}{'vid drop':>10}{'failed':>8}"
+    )
+    saturation = None
+    first_failed = None
+    for sessions in [int(n) for n in args.steps.split(",")]:
+        r = asyncio.run(run_step(sessions, args))
+        print(
+            f"{r['sessions']:>8}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+            f"{r['downlink_p99_ms']:>10.1f}{r['cpu_pct_per_session']:>11.2f}{r['cpu_pct_total']:>10.1f}"
+            f"{r['mem_kb_per_session']:>9.0f}{r['audio_loss_pct']:>11.2f}{r['video_dropped']:>10}{r['failed']:>8}"
+        )
+        if first_failed is None:
+            first_failed = r["failed"]
+        if saturated(r, args):
+            saturation = r["sessions"]
+            break
+
+    if saturation is None:
+        print("Saturation not reached at the largest step.")
+    else:
+        print(f"Saturated at {saturation} sessions.")
+    # Sessions failing at the first step mean the proxy itself is broken
+    sys.exit(1 if first_failed else 0)
+
+
+if __name__ == "__main__":
+    main()
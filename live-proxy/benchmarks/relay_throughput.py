@@ -0,0 +1,170 @@
+"""Relay throughput of the proxy, text mode vs. passthrough.
+
+Starts server.py as a subprocess and points it at a FakeGemini that
+echoes every frame back as a binary frame, as Gemini does. Each session
+streams realtime_input messages shaped like the web app's: 4096-sample
+16 kHz PCM chunks, plus a JPEG frame about every four chunks (1 FPS), all
+base64 inside JSON. The proxy's CPU time comes from
+its rusage once it exits, so the result is messages relayed per second of
+one core, with the client and fake server excluded.
+
+    python benchmarks/relay_throughput.py [--sessions 8] [--messages 2000]
+
+Needs no credentials or network access.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGemini  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+AUDIO_BYTES = 4096 * 2
+VIDEO_EVERY = 4
+# How long to wait for trailing video echoes once all audio is back
+DRAIN_SECONDS = 0.5
+
+
+def is_video(frame) -> bool:
+    return ("image/" if isinstance(frame, str) else b"image/") in frame[:80]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_messages(frame_kb: int) -> list:
+    audio = json.dumps({"realtime_input": {"media_chunks": [
+        {"mime_type": "audio/pcm", "data": base64.b64encode(os.urandom(AUDIO_BYTES)).decode()}
+    ]}})
+    video = json.dumps({"realtime_input": {"media_chunks": [
+        {"mime_type": "image/jpeg", "data": base64.b64encode(os.urandom(frame_kb * 1024)).decode()}
+    ]}})
+    return [audio] * (VIDEO_EVERY - 1) + [video]
+
+
+async def session(proxy_url: str, upstream_url: str, passthrough: bool, messages: list, count: int) -> int:
+    """Streams `count` messages and returns how many came back.
+
+    The proxy may drop superseded video frames, so only audio echoes are
+    waited for; video still in flight is drained for a short grace period.
+    """
+    audio_expected = sum(1 for i in range(count) if not is_video(messages[i % len(messages)]))
+    async with websockets.connect(proxy_url, max_size=None) as ws:
+        await ws.send(json.dumps({
+            "bearer_token": "benchmark",
+            "service_url": upstream_url,
+            "passthrough": passthrough,
+        }))
+
+        async def send():
+            for i in range(count):
+                await ws.send(messages[i % len(messages)])
+
+        sender = asyncio.create_task(send())
+        echoed = audio_echoed = 0
+        while audio_echoed < audio_expected:
+            frame = await ws.recv()
+            echoed += 1
+            audio_echoed += not is_video(frame)
+        await sender
+        try:
+            while True:
+                await asyncio.wait_for(ws.recv(), timeout=DRAIN_SECONDS)
+                echoed += 1
+        except asyncio.TimeoutError:
+            pass
+        return echoed
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"proxy did not start on port {port}")
+
+
+async def run(passthrough: bool, args) -> dict:
+    upstream_port, proxy_port = free_port(), free_port()
+    messages = make_messages(args.frame_kb)
+
+    async with FakeGemini().serve("127.0.0.1", upstream_port):
+        proc = subprocess.Popen(
+            [sys.executable, SERVER],
+            env={
+                **os.environ, "PORT": str(proxy_port), "PROXY_PASSTHROUGH": "0",
+                "PROXY_ALLOW_INSECURE_UPSTREAM": "1",
+            },
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            await wait_for_port(proxy_port)
+            start = time.perf_counter()
+            echoed = await asyncio.gather(*(
+                session(
+                    f"ws://127.0.0.1:{proxy_port}/ws", f"ws://127.0.0.1:{upstream_port}",
+                    passthrough, messages, args.messages,
+                )
+                for _ in range(args.sessions)
+            ))
+            # Leave out the final drain wait, which is idle time
+            elapsed = time.perf_counter() - start - DRAIN_SECONDS
+        finally:
+            proc.send_signal(signal.SIGINT)
+            _, _, usage = os.wait4(proc.pid, 0)
+
+    cpu = usage.ru_utime + usage.ru_stime
+    # Each echoed message crossed the proxy twice: client -> Gemini and back.
+    # Dropped video frames never left the proxy and are not counted.
+    relayed = 2 * sum(echoed)
+    return {
+        "mode": "passthrough" if passthrough else "text",
+        "relayed": relayed,
+        "video_dropped": args.sessions * args.messages - sum(echoed),
+        "wall_s": elapsed,
+        "cpu_s": cpu,
+        "msgs_per_s": relayed / elapsed,
+        "msgs_per_core_s": relayed / cpu if cpu else float("inf"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=2000, help="messages per session")
+    parser.add_argument("--frame-kb", type=int, default=40, help="JPEG frame size")
+    args = parser.parse_args()
+
+    print(
+        f"{'mode':<12}{'relayed':>10}{'dropped':>9}{'wall s':>9}{'cpu s':>9}{'msg/s':>10}{'msg/core-s':>12}"
+    )
+    for passthrough in (False, True):
+        r = asyncio.run(run(passthrough, args))
+        print(
+            f"{r['mode']:<12}{r['relayed']:>10}{r['video_dropped']:>9}{r['wall_s']:>9.2f}{r['cpu_s']:>9.2f}"
+            f"{r['msgs_per_s']:>10.0f}{r['msgs_per_core_s']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
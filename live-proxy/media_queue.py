@@ -0,0 +1,190 @@
+"""Bounded, media-aware send queue for one direction of a live session.
+
+Audio and control messages (setup, client content, tool responses,
+everything Gemini sends back) are latency critical. They are never
+dropped and always go out first. Webcam frames are only useful while
+fresh. Just the newest pending frame is kept, and a frame that waited
+longer than `max_video_age` is discarded rather than sent late.
+
+When the upstream side slows down, the queue of priority messages fills
+up to `max_pending`. `put` then waits, which stops reading from the
+sender and pushes backpressure down to its TCP connection.
+
+With `coalesce` set, an audio chunk about to be sent waits up to that
+many seconds for the audio chunks behind it. Consecutive chunks are
+merged into one realtime_input message with several media_chunks,
+up to `coalesce_max_bytes`. Any other message ends the batch, so
+turn completions, interruptions and tool responses are never held back.
+
+Frames are classified by sniffing the start of the raw message, so
+passthrough mode never has to parse JSON.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+# The web client sends {"realtime_input":{"media_chunks":[{"mime_type":"image/jpeg","data":...
+SNIFF_CHARS = 128
+CHUNKS_PREFIX = '{"realtime_input":{"media_chunks":['
+CHUNKS_SUFFIX = "]}}"
+
+
+def is_video(frame) -> bool:
+    head = frame[:SNIFF_CHARS]
+    if isinstance(head, bytes):
+        return b"realtime_input" in head and b'"image/' in head
+    return "realtime_input" in head and '"image/' in head
+
+
+def is_audio_chunk(frame) -> bool:
+    """True for a media_chunks message carrying audio only, which can be merged."""
+    if isinstance(frame, bytes):
+        return (
+            frame.startswith(CHUNKS_PREFIX.encode()) and frame.endswith(CHUNKS_SUFFIX.encode())
+            and b'"audio/' in frame[:SNIFF_CHARS]
+        )
+    return (
+        frame.startswith(CHUNKS_PREFIX) and frame.endswith(CHUNKS_SUFFIX)
+        and '"audio/' in frame[:SNIFF_CHARS]
+    )
+
+
+def merge_audio_chunks(frames: list):
+    """Joins the media_chunks of several audio messages into one message."""
+    if len(frames) == 1:
+        return frames[0]
+    start, end = len(CHUNKS_PREFIX), -len(CHUNKS_SUFFIX)
+    if isinstance(frames[0], bytes):
+        inner = [(f if isinstance(f, bytes) else f.encode())[start:end] for f in frames]
+        return CHUNKS_PREFIX.encode() + b",".join(inner) + CHUNKS_SUFFIX.encode()
+    inner = [(f if isinstance(f, str) else f.decode())[start:end] for f in frames]
+    return CHUNKS_PREFIX + ",".join(inner) + CHUNKS_SUFFIX
+
+
+class MediaQueue:
+    def __init__(
+        self,
+        max_pending: int = 64,
+        max_video_age: float = 2.0,
+        coalesce: float = 0.0,
+        coalesce_max_bytes: int = 65536,
+    ):
+        self.max_pending = max_pending
+        self.max_video_age = max_video_age
+        self.coalesce = coalesce
+        self.coalesce_max_bytes = coalesce_max_bytes
+        self._priority: deque = deque()
+        self._video = None
+        self._closed = False
+        self._changed = asyncio.Event()
+        self.forwarded = 0
+        self.video_dropped = 0
+        self.max_depth = 0
+        self.max_delay = 0.0
+        self._total_delay = 0.0
+        # When the frame last returned by `get` was queued
+        self.last_queued_at = None
+        self.audio_chunks = 0
+        self.audio_messages = 0
+        self._total_coalesce_wait = 0.0
+
+    def _notify(self):
+        self._changed.set()
+
+    async def _wait(self):
+        self._changed.clear()
+        await self._changed.wait()
+
+    async def put(self, frame) -> bool:
+        """Queues a frame. Returns False once the queue has been closed."""
+        if self._closed:
+            return False
+        now = time.monotonic()
+        if is_video(frame):
+            if self._video is not None:
+                self.video_dropped += 1
+            self._video = (now, frame)
+        else:
+            while len(self._priority) >= self.max_pending and not self._closed:
+                await self._wait()
+            if self._closed:
+                return False
+            self._priority.append((now, frame))
+            self.max_depth = max(self.max_depth, len(self._priority))
+        self._notify()
+        return True
+
+    async def get(self):
+        """Returns the next frame to send, or None once closed and drained."""
+        while True:
+            if self._priority:
+                queued_at, frame = self._priority.popleft()
+            elif self._video is not None:
+                (queued_at, frame), self._video = self._video, None
+                if time.monotonic() - queued_at > self.max_video_age:
+                    self.video_dropped += 1
+                    continue
+            elif self._closed:
+                return None
+            else:
+                await self._wait()
+                continue
+            if self.coalesce and is_audio_chunk(frame):
+                frame = await self._coalesce(frame)
+            delay = time.monotonic() - queued_at
+            self.last_queued_at = queued_at
+            self.forwarded += 1
+            self._total_delay += delay
+            self.max_delay = max(self.max_delay, delay)
+            self._notify()
+            return frame
+
+    async def _coalesce(self, first):
+        """Merges the audio chunks queued right behind `first`, waiting briefly for more."""
+        frames, size = [first], len(first)
+        started = time.monotonic()
+        deadline = started + self.coalesce
+        while size < self.coalesce_max_bytes:
+            if self._priority:
+                if not is_audio_chunk(self._priority[0][1]):
+                    break
+                _, frame = self._priority.popleft()
+                frames.append(frame)
+                size += len(frame)
+                self._notify()
+                continue
+            remaining = deadline - time.monotonic()
+            if self._closed or remaining <= 0:
+                break
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        self.audio_chunks += len(frames)
+        self.audio_messages += 1
+        self._total_coalesce_wait += time.monotonic() - started
+        return merge_audio_chunks(frames)
+
+    def close(self):
+        """Stops accepting frames; `get` still drains what is queued."""
+        self._closed = True
+        self._notify()
+
+    def stats(self) -> dict:
+        return {
+            "forwarded": self.forwarded,
+            "video_dropped": self.video_dropped,
+            "pending": len(self._priority) + (self._video is not None),
+            "max_depth": self.max_depth,
+            "avg_delay_ms": round(self._total_delay / self.forwarded * 1000, 2) if self.forwarded else 0.0,
+            "max_delay_ms": round(self.max_delay * 1000, 2),
+            "coalesce_ms": self.coalesce * 1000,
+            "audio_chunks": self.audio_chunks,
+            "audio_messages": self.audio_messages,
+            "chunks_per_message": round(self.audio_chunks / self.audio_messages, 2) if self.audio_messages else 0.0,
+            "avg_coalesce_wait_ms": (
+                round(self._total_coalesce_wait / self.audio_messages * 1000, 2) if self.audio_messages else 0.0
+            ),
+        }
@@ -1,92 +1,202 @@
 #!/usr/bin/env python3
 """WebSocket Proxy Server for Gemini Live API.
-Deployed on Cloud Run. Serves HTTP health checks and WebSocket proxy on the same port.
+Deployed on Cloud Run. Serves HTTP health checks, Prometheus metrics and WebSocket proxy on the same port.
 """
 
 import asyncio
 import json
 import os
 import ssl
+import time
+from datetime import datetime
 
 import certifi
 import google.auth
 import websockets
 from aiohttp import web
 from google.auth.transport.requests import Request
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from websockets.exceptions import ConnectionClosed
 
-PORT = int(os.environ.get("PORT", 8080))
-
+from media_queue import MediaQueue
+from telemetry import LiveSession
 
-def generate_access_token():
-    """Retrieves an access token using Google Cloud default credentials."""
-    try:
-        creds, _ = google.auth.default()
-        if not creds.valid:
-            creds.refresh(Request())
-        return creds.token
-    except Exception as e:
-        print(f"Error generating access token: {e}")
-        return None
+PORT = int(os.environ.get("PORT", 8080))
+# Forward frames verbatim, keeping their text/binary type. Clients can also
+# opt in per connection with "passthrough": true in the setup message.
+PASSTHROUGH = os.environ.get("PROXY_PASSTHROUGH", "0") == "1"
+
+# CA bundle is read once; every upstream connection reuses this context
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+# Accept plain ws:// upstreams. Only the benchmarks' local fake Gemini needs
+# this; elsewhere it would send the proxy's access token unencrypted.
+ALLOW_INSECURE_UPSTREAM = os.environ.get("PROXY_ALLOW_INSECURE_UPSTREAM", "0") == "1"
+# Refresh the cached token this long before it expires
+TOKEN_REFRESH_MARGIN = float(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+TOKEN_RETRY_SECONDS = 30.0
+# Audio/control messages buffered per direction before reads are paused
+QUEUE_MAX_PENDING = int(os.environ.get("LIVE_QUEUE_MAX_PENDING", "64"))
+# Webcam frames that waited longer than this are dropped instead of sent
+MAX_VIDEO_AGE = float(os.environ.get("LIVE_MAX_VIDEO_AGE_MS", "2000")) / 1000
+# Latency budget for merging consecutive audio chunks sent to Gemini; 0
+# disables it. Clients can set "coalesce_ms" in the setup message instead.
+COALESCE_MS = float(os.environ.get("LIVE_COALESCE_MS", "0"))
+COALESCE_MAX_BYTES = int(os.environ.get("LIVE_COALESCE_MAX_BYTES", "65536"))
+
+# Session ID -> every open client session, for /
+active_sessions = {}
+
+
+class TokenManager:
+    """Process-wide access token from Google Cloud default credentials.
+
+    The token is fetched at startup and refreshed by a background task
+    ahead of expiry, so new sessions read it without touching the network.
+    Credential calls block, so they run in a worker thread.
+    """
+
+    def __init__(self):
+        self._creds = None
+        self._transport = Request()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _seconds_left(self) -> float:
+        if self._creds is None or not self._creds.token:
+            return 0.0
+        if self._creds.expiry is None:
+            return float("inf")
+        # google-auth keeps expiry as a naive UTC datetime
+        return (self._creds.expiry - datetime.utcnow()).total_seconds()
+
+    def _refresh_sync(self):
+        if self._creds is None:
+            self._creds, _ = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+        self._creds.refresh(self._transport)
+
+    async def refresh(self):
+        async with self._lock:
+            # Another caller may have refreshed while we waited for the lock
+            if self._seconds_left() > TOKEN_REFRESH_MARGIN:
+                return
+            await asyncio.to_thread(self._refresh_sync)
+            print(f"🔑 Access token refreshed, expires in {self._seconds_left():.0f}s")
+
+    async def get_token(self):
+        """Returns a valid access token, or None if credentials are unavailable."""
+        try:
+            if self._seconds_left() <= TOKEN_REFRESH_MARGIN:
+                await self.refresh()
+            return self._creds.token
+        except Exception as e:
+            print(f"Error generating access token: {e}")
+            return None
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+                delay = max(self._seconds_left() - TOKEN_REFRESH_MARGIN, TOKEN_RETRY_SECONDS)
+            except Exception as e:
+                print(f"Error refreshing access token: {e}")
+                delay = TOKEN_RETRY_SECONDS
+            await asyncio.sleep(delay)
 
+    def start(self):
+        self._task = asyncio.create_task(self._refresh_loop())
 
-async def proxy_task(source_ws, dest_ws, label):
-    """Forward messages between two WebSocket connections."""
-    try:
-        async for message in source_ws:
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
             try:
-                data = json.loads(message)
-                await dest_ws.send(json.dumps(data))
-            except Exception as e:
-                print(f"Error proxying from {label}: {e}")
-    except ConnectionClosed as e:
-        print(f"{label} connection closed: {e.code}")
-    except Exception as e:
-        print(f"Unexpected error in {label} proxy: {e}")
-    finally:
-        try:
-            await dest_ws.close()
-        except Exception:
-            pass
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
 
-async def create_proxy(client_ws, bearer_token, service_url):
-    """Establish bidirectional proxy between client and Gemini."""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {bearer_token}",
-    }
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
+tokens = TokenManager()
 
-    print("Connecting to Gemini Live API...")
-    try:
-        async with websockets.connect(
-            service_url, additional_headers=headers, ssl=ssl_context
-        ) as server_ws:
-            print("✅ Connected to Gemini Live API")
 
-            c2s = asyncio.create_task(
-                proxy_task(client_ws, server_ws, "client→server")
-            )
-            s2c = asyncio.create_task(
-                proxy_task(server_ws, client_ws, "server→client")
-            )
+async def _drain(session, direction, send):
+    """Sends queued frames until the queue is closed and empty."""
+    queue = session.queues[direction]
+    try:
+        while (frame := await queue.get()) is not None:
+            await send(frame)
+            session.sent(direction, time.monotonic() - queue.last_queued_at)
+    finally:
+        # Unblock the reader if the destination went away first
+        queue.close()
 
-            done, pending = await asyncio.wait(
-                [c2s, s2c], return_when=asyncio.FIRST_COMPLETED
-            )
 
-            for task in pending:
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
+async def relay_client_to_gemini(ws, gemini_ws, session):
+    """Forwards client frames to Gemini through the session's queue.
 
-    except ConnectionClosed as e:
-        print(f"Server connection closed: {e.code} - {e.reason}")
+    Binary frames are only forwarded in passthrough mode; otherwise the
+    proxy accepts text frames alone, as it always has.
+    """
+    queue = session.queues["to_gemini"]
+    writer = asyncio.create_task(_drain(session, "to_gemini", gemini_ws.send))
+    try:
+        async for msg in ws:
+            if msg.type == web.WSMsgType.TEXT or (
+                msg.type == web.WSMsgType.BINARY and session.passthrough
+            ):
+                session.received("to_gemini", msg.data)
+                if not await queue.put(msg.data):
+                    break
+            elif msg.type in (
+                web.WSMsgType.CLOSE,
+                web.WSMsgType.ERROR,
+            ):
+                break
+        queue.close()
+        await writer
+    except ConnectionClosed:
+        pass
     except Exception as e:
-        print(f"Failed to connect to Gemini API: {e}")
+        print(f"Client→Gemini error: {e}")
+    finally:
+        writer.cancel()
+        await gemini_ws.close()
+
+
+async def relay_gemini_to_client(gemini_ws, ws, session):
+    """Forwards Gemini frames to the client through the session's queue.
+
+    Gemini sends its JSON messages as binary frames. In passthrough mode
+    they go out unchanged as binary; otherwise they are decoded and sent as
+    text for clients that only read text frames.
+    """
+    async def send(message):
+        if isinstance(message, str):
+            await ws.send_str(message)
+        elif session.passthrough:
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(message.decode())
+
+    queue = session.queues["to_client"]
+    writer = asyncio.create_task(_drain(session, "to_client", send))
+    try:
+        async for message in gemini_ws:
+            if ws.closed:
+                break
+            session.received("to_client", message)
+            if not await queue.put(message):
+                break
+        queue.close()
+        await writer
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        print(f"Gemini→Client error: {e}")
+    finally:
+        writer.cancel()
+        if not ws.closed:
+            await ws.close()
 
 
 async def websocket_handler(request):
@@ -94,95 +204,94 @@ async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
-    print("🔌 New WebSocket client via aiohttp...")
+    session = LiveSession()
+    active_sessions[session.id] = session
+    print(f"🔌 New WebSocket client via aiohttp (session {session.id})...")
     try:
         setup_raw = await asyncio.wait_for(ws.receive_str(), timeout=10.0)
         setup_data = json.loads(setup_raw)
 
         bearer_token = setup_data.get("bearer_token")
         service_url = setup_data.get("service_url")
+        session.passthrough = PASSTHROUGH or bool(setup_data.get("passthrough"))
+        coalesce_ms = float(setup_data.get("coalesce_ms", COALESCE_MS))
 
         if not bearer_token:
-            print("🔑 Generating access token...")
-            bearer_token = generate_access_token()
+            bearer_token = await tokens.get_token()
             if not bearer_token:
                 print("❌ Failed to generate access token")
+                session.close_reason = "auth_failed"
                 await ws.close(code=1008, message=b"Authentication failed")
                 return ws
 
         if not service_url:
+            session.close_reason = "no_service_url"
             await ws.close(code=1008, message=b"Service URL required")
             return ws
 
-        # Create SSL context
+        secure = service_url.startswith("wss://")
+        if not secure and not ALLOW_INSECURE_UPSTREAM:
+            session.close_reason = "insecure_service_url"
+            await ws.close(code=1008, message=b"Service URL must use wss://")
+            return ws
+
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {bearer_token}",
         }
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        # Plain ws:// is only allowed for local test servers
+        ssl_context = SSL_CONTEXT if secure else None
 
         print("Connecting to Gemini Live API...")
+        session.close_reason = "upstream_connect_failed"
+        connect_started = time.monotonic()
         async with websockets.connect(
             service_url, additional_headers=headers, ssl=ssl_context
         ) as gemini_ws:
-            print("✅ Connected to Gemini Live API")
-
-            async def client_to_gemini():
-                try:
-                    async for msg in ws:
-                        if msg.type == web.WSMsgType.TEXT:
-                            await gemini_ws.send(msg.data)
-                        elif msg.type in (
-                            web.WSMsgType.CLOSE,
-                            web.WSMsgType.ERROR,
-                        ):
-                            break
-                except Exception as e:
-                    print(f"Client→Gemini error: {e}")
-                finally:
-                    await gemini_ws.close()
-
-            async def gemini_to_client():
-                try:
-                    async for message in gemini_ws:
-                        if ws.closed:
-                            break
-                        await ws.send_str(
-                            message
-                            if isinstance(message, str)
-                            else message.decode()
-                        )
-                except ConnectionClosed:
-                    pass
-                except Exception as e:
-                    print(f"Gemini→Client error: {e}")
-                finally:
-                    if not ws.closed:
-                        await ws.close()
-
-            c2g = asyncio.create_task(client_to_gemini())
-            g2c = asyncio.create_task(gemini_to_client())
+            session.upstream_connected(connect_started)
+            session.close_reason = "error"
+            print(
+                f"✅ Connected to Gemini Live API in {session.connect_seconds * 1000:.0f}ms "
+                f"(passthrough={session.passthrough})"
+            )
+
+            session.queues = {
+                "to_gemini": MediaQueue(
+                    QUEUE_MAX_PENDING, MAX_VIDEO_AGE, coalesce_ms / 1000, COALESCE_MAX_BYTES
+                ),
+                "to_client": MediaQueue(QUEUE_MAX_PENDING, MAX_VIDEO_AGE),
+            }
+            c2g = asyncio.create_task(relay_client_to_gemini(ws, gemini_ws, session))
+            g2c = asyncio.create_task(relay_gemini_to_client(gemini_ws, ws, session))
             done, pending = await asyncio.wait(
                 [c2g, g2c], return_when=asyncio.FIRST_COMPLETED
             )
+            session.close_reason = "client_closed" if c2g in done else "upstream_closed"
             for t in pending:
                 t.cancel()
 
     except asyncio.TimeoutError:
         print("⏱️ Timeout waiting for setup")
+        session.close_reason = "setup_timeout"
         await ws.close(code=1008, message=b"Timeout")
     except Exception as e:
         print(f"❌ Error: {e}")
         if not ws.closed:
             await ws.close(code=1011, message=b"Internal error")
+    finally:
+        del active_sessions[session.id]
+        session.close()
 
     return ws
 
 
 async def health_check(request):
-    """Health check for Cloud Run."""
+    """Health check for Cloud Run, with per-session counters."""
     return web.Response(
-        text=json.dumps({"status": "ok"}),
+        text=json.dumps({
+            "status": "ok",
+            "sessions": [session.stats() for session in active_sessions.values()],
+        }),
         content_type="application/json",
         headers={
             "Access-Control-Allow-Origin": "*",
@@ -190,6 +299,11 @@ async def health_check(request):
     )
 
 
+async def metrics(request):
+    """Prometheus scrape endpoint."""
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
 async def options_handler(request):
     """CORS preflight."""
     return web.Response(
@@ -201,9 +315,18 @@ async def options_handler(request):
     )
 
 
+async def token_refresher(app):
+    """Keeps the access token warm for the lifetime of the server."""
+    tokens.start()
+    yield
+    await tokens.stop()
+
+
 def main():
     app = web.Application()
+    app.cleanup_ctx.append(token_refresher)
     app.router.add_get("/", health_check)
+    app.router.add_get("/metrics", metrics)
     app.router.add_get("/ws", websocket_handler)
     app.router.add_options("/{path:.*}", options_handler)
 
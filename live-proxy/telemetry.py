@@ -0,0 +1,138 @@
+"""Per-session accounting and Prometheus metrics for the live proxy.
+
+Every WebSocket client gets a LiveSession from the moment it connects. It
+records how long the upstream connect and Gemini's first message took,
+the messages and bytes received from each side, and relay lag. Relay lag
+is the time from a frame arriving at the proxy to its write to the other
+side completing. A slow upstream shows up as a slow connect or first
+message; a struggling proxy shows up as relay lag.
+
+Aggregates are exported in Prometheus text format on /metrics. Each
+session is also logged as one JSON line when it closes, which Cloud
+Logging indexes as a structured entry.
+"""
+
+import itertools
+import json
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+DIRECTIONS = ("to_gemini", "to_client")
+
+ACTIVE_SESSIONS = Gauge(
+    "live_proxy_active_sessions",
+    "Client WebSocket sessions currently open.",
+)
+SESSIONS = Counter(
+    "live_proxy_sessions_total",
+    "Sessions closed, by close reason.",
+    ["reason"],
+)
+SESSION_SECONDS = Histogram(
+    "live_proxy_session_seconds",
+    "Session duration from client connect to close.",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+UPSTREAM_CONNECT_SECONDS = Histogram(
+    "live_proxy_upstream_connect_seconds",
+    "Time to open the WebSocket to Gemini.",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+FIRST_MESSAGE_SECONDS = Histogram(
+    "live_proxy_first_server_message_seconds",
+    "Time from the upstream connect to Gemini's first message.",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+MESSAGES = Counter(
+    "live_proxy_messages_total",
+    "Messages received for relay, by direction.",
+    ["direction"],
+)
+BYTES = Counter(
+    "live_proxy_bytes_total",
+    "Payload bytes received for relay, by direction.",
+    ["direction"],
+)
+RELAY_LAG_SECONDS = Histogram(
+    "live_proxy_relay_lag_seconds",
+    "Time from a message reaching the proxy to its write completing.",
+    ["direction"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+VIDEO_DROPPED = Counter(
+    "live_proxy_video_frames_dropped_total",
+    "Webcam frames dropped as stale or superseded.",
+)
+
+_session_ids = itertools.count(1)
+
+
+class LiveSession:
+    def __init__(self):
+        self.id = next(_session_ids)
+        self.started = time.monotonic()
+        self.passthrough = False
+        self.close_reason = "error"
+        self.connect_seconds = None
+        self.first_message_seconds = None
+        self.messages = dict.fromkeys(DIRECTIONS, 0)
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.max_lag = dict.fromkeys(DIRECTIONS, 0.0)
+        self._total_lag = dict.fromkeys(DIRECTIONS, 0.0)
+        self._sent = dict.fromkeys(DIRECTIONS, 0)
+        self._connected_at = None
+        self.queues = {}
+        ACTIVE_SESSIONS.inc()
+
+    def upstream_connected(self, connect_started: float):
+        self._connected_at = time.monotonic()
+        self.connect_seconds = self._connected_at - connect_started
+        UPSTREAM_CONNECT_SECONDS.observe(self.connect_seconds)
+
+    def received(self, direction: str, frame):
+        if direction == "to_client" and self.first_message_seconds is None:
+            self.first_message_seconds = time.monotonic() - self._connected_at
+            FIRST_MESSAGE_SECONDS.observe(self.first_message_seconds)
+        self.messages[direction] += 1
+        self.bytes[direction] += len(frame)
+        MESSAGES.labels(direction).inc()
+        BYTES.labels(direction).inc(len(frame))
+
+    def sent(self, direction: str, lag: float):
+        self._sent[direction] += 1
+        self._total_lag[direction] += lag
+        self.max_lag[direction] = max(self.max_lag[direction], lag)
+        RELAY_LAG_SECONDS.labels(direction).observe(lag)
+
+    def close(self):
+        ACTIVE_SESSIONS.dec()
+        SESSIONS.labels(self.close_reason).inc()
+        SESSION_SECONDS.observe(time.monotonic() - self.started)
+        for queue in self.queues.values():
+            VIDEO_DROPPED.inc(queue.video_dropped)
+        print(json.dumps({"event": "live_session_closed", **self.stats()}))
+
+    def stats(self) -> dict:
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        return {
+            "session_id": self.id,
+            "passthrough": self.passthrough,
+            "close_reason": self.close_reason,
+            "duration_s": round(time.monotonic() - self.started, 1),
+            "upstream_connect_ms": ms(self.connect_seconds),
+            "first_server_message_ms": ms(self.first_message_seconds),
+            **{
+                direction: {
+                    "messages": self.messages[direction],
+                    "bytes": self.bytes[direction],
+                    "avg_lag_ms": ms(self._total_lag[direction] / self._sent[direction])
+                    if self._sent[direction] else 0.0,
+                    "max_lag_ms": ms(self.max_lag[direction]),
+                    **(self.queues[direction].stats() if direction in self.queues else {}),
+                }
+                for direction in DIRECTIONS
+            },
+        }
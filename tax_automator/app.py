@@ -1,74 +1,402 @@
 import os
+import asyncio
 import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+from google.genai import types
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel
+
+import export
+import metrics
+import receipts_db
+import tools
+from extraction_cache import ExtractionCache, image_key
+from idempotency import RecentlySeen, claim_receipt
+from image_prep import prepare_image
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Tax Automator Agent")
+APP_NAME = "tax_automator"
+PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator")
+# Upper bound on agent sessions alive at the same time in this instance.
+MAX_AGENT_SESSIONS = int(os.environ.get("MAX_AGENT_SESSIONS", "8"))
+# Number of receipts from /process_receipts worked on concurrently.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "500"))
+# How long finished batches can still be polled, and how many are kept.
+BATCH_RESULTS_TTL_SECONDS = float(os.environ.get("BATCH_RESULTS_TTL_SECONDS", "3600"))
+MAX_TRACKED_BATCHES = int(os.environ.get("MAX_TRACKED_BATCHES", "100"))
+# Receipts from all batches waiting for a worker before new batches get 429.
+MAX_QUEUED_RECEIPTS = int(os.environ.get("MAX_QUEUED_RECEIPTS", "2000"))
+# How long event and receipt IDs are remembered to drop redeliveries.
+DEDUP_TTL_SECONDS = float(os.environ.get("DEDUP_TTL_SECONDS", "600"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "10000"))
+EXTRACTION_CACHE_TTL_SECONDS = float(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get("EXTRACTION_CACHE_MAX_ENTRIES", "1024"))
+# Web app origins allowed to call /export from the browser.
+EXPORT_ALLOWED_ORIGINS = os.environ.get("EXPORT_ALLOWED_ORIGINS", "*").split(",")
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+class AgentRuntime:
+    """Process-wide Firestore client, ADK runner and bounded session pool.
+
+    Built once at startup so each Eventarc event only pays for the agent run
+    itself. Every receipt gets its own session, which is deleted again as soon
+    as the run finishes so no conversation state leaks between receipts.
+    """
+
+    def __init__(self, max_sessions: int = MAX_AGENT_SESSIONS):
+        from google.adk.runners import Runner
+        from google.adk.sessions.in_memory_session_service import InMemorySessionService
+        from agent import root_agent
+
+        self.db = receipts_db.get_db()
+        self.storage = storage.Client(project=PROJECT_ID)
+        self.session_service = InMemorySessionService()
+        self.runner = Runner(
+            agent=root_agent,
+            app_name=APP_NAME,
+            session_service=self.session_service,
+        )
+        self._slots = asyncio.Semaphore(max_sessions)
+        self.recently_seen = RecentlySeen(DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES)
+        self.extraction_cache = ExtractionCache(
+            self.db, EXTRACTION_CACHE_TTL_SECONDS, EXTRACTION_CACHE_MAX_ENTRIES
+        )
+
+    @asynccontextmanager
+    async def session(self, user_id: str = "system"):
+        """Yields an isolated session, waiting for a free slot if the pool is full."""
+        async with self._slots:
+            session = await self.session_service.create_session(
+                app_name=APP_NAME,
+                user_id=user_id,
+            )
+            try:
+                yield session
+            finally:
+                await self.session_service.delete_session(
+                    app_name=APP_NAME,
+                    user_id=user_id,
+                    session_id=session.id,
+                )
+
+    def download(self, gcs_uri: str) -> bytes:
+        blob = storage.Blob.from_string(gcs_uri, client=self.storage)
+        return blob.download_as_bytes()
+
+    async def run(self, parts, user_id: str = "system"):
+        """Runs the agent on a single message in a fresh pooled session."""
+        async with self.session(user_id) as session, metrics.stage("agent_run"):
+            async for event in self.runner.run_async(
+                user_id=user_id,
+                session_id=session.id,
+                new_message=types.Content(role="user", parts=parts),
+            ):
+                if event.content and event.content.parts:
+                    for part in event.content.parts:
+                        if part.text:
+                            logger.info(f"Agent: {part.text[:200]}")
+
+
+class ReceiptQueue:
+    """In-process work queue drained by a fixed number of workers.
+
+    Callers get a future per receipt, so a batch can be submitted at once and
+    collected in order while at most `concurrency` agent runs are in flight.
+    At most `max_pending` receipts wait for a worker.
+    """
+
+    def __init__(self, handler, concurrency: int = BATCH_CONCURRENCY, max_pending: int = MAX_QUEUED_RECEIPTS):
+        self._handler = handler
+        self._concurrency = concurrency
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._workers = []
+
+    def start(self):
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._concurrency)
+        ]
+
+    async def stop(self):
+        """Cancels the workers and fails every receipt still waiting for one."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Receipt queue stopped"))
+
+    def has_room(self, count: int) -> bool:
+        return self._queue.qsize() + count <= self._queue.maxsize
+
+    def submit(self, receipt_id: str) -> asyncio.Future:
+        """Queues a receipt; raises asyncio.QueueFull if no room is left."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((receipt_id, future))
+        return future
+
+    async def _worker(self):
+        while True:
+            receipt_id, future = await self._queue.get()
+            try:
+                result = await self._handler(receipt_id)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.set_exception(RuntimeError("Receipt queue stopped"))
+                raise
+            finally:
+                self._queue.task_done()
+
+
+class BatchRequest(BaseModel):
+    receipt_ids: List[str]
+
+
+class Batch:
+    """Progress of one /process_receipts request, kept for polling.
+
+    Batches live in the memory of the instance that accepted them.
+    """
+
+    def __init__(self, receipt_ids: List[str]):
+        self.id = uuid.uuid4().hex
+        self.receipt_ids = receipt_ids
+        self.results = {}
+        self.finished_at = None
+
+    def watch(self, receipt_id: str, future: asyncio.Future):
+        def done(future: asyncio.Future):
+            if future.cancelled():
+                result = {"status": "failed", "receipt_id": receipt_id, "error": "cancelled"}
+            elif future.exception() is not None:
+                logger.error(f"Batch item {receipt_id} failed: {future.exception()}")
+                result = {"status": "failed", "receipt_id": receipt_id, "error": str(future.exception())}
+            else:
+                result = future.result()
+            self.results[receipt_id] = result
+            if len(self.results) == len(self.receipt_ids):
+                self.finished_at = time.monotonic()
+                logger.info(f"Batch {self.id} finished: {self.summary()}")
+
+        future.add_done_callback(done)
+
+    def summary(self) -> dict:
+        summary = {}
+        for result in self.results.values():
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+        return summary
+
+    def view(self) -> dict:
+        return {
+            "batch_id": self.id,
+            "status": "done" if self.finished_at else "running",
+            "total": len(self.receipt_ids),
+            "finished": len(self.results),
+            "summary": self.summary(),
+            "results": [self.results[r] for r in self.receipt_ids if r in self.results],
+        }
+
+
+runtime: AgentRuntime = None
+queue: ReceiptQueue = None
+# batch_id -> Batch, oldest first
+batches: "OrderedDict[str, Batch]" = OrderedDict()
+
+
+def track_batch(batch: Batch) -> bool:
+    """Registers a batch, making room by forgetting finished batches.
+
+    Batches finished more than BATCH_RESULTS_TTL_SECONDS ago are dropped,
+    then the oldest finished ones while the table is full. Running batches
+    are never dropped; returns False if the table is full of them.
+    """
+    now = time.monotonic()
+    for batch_id, old in list(batches.items()):
+        if old.finished_at and now - old.finished_at > BATCH_RESULTS_TTL_SECONDS:
+            del batches[batch_id]
+    for batch_id, old in list(batches.items()):
+        if len(batches) < MAX_TRACKED_BATCHES:
+            break
+        if old.finished_at:
+            del batches[batch_id]
+    if len(batches) >= MAX_TRACKED_BATCHES:
+        return False
+    batches[batch.id] = batch
+    return True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global runtime, queue
+    runtime = AgentRuntime()
+    queue = ReceiptQueue(handle_receipt)
+    queue.start()
+    logger.info(
+        f"Agent runtime ready (max {MAX_AGENT_SESSIONS} sessions, "
+        f"batch concurrency {BATCH_CONCURRENCY})"
+    )
+    yield
+    await queue.stop()
+
+
+app = FastAPI(title="Tax Automator Agent", lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=EXPORT_ALLOWED_ORIGINS,
+    allow_methods=["GET"],
+    allow_headers=["Authorization"],
+)
 
 
 @app.get("/")
 async def root():
-    return {"status": "ok", "service": "tax-automator-agent"}
+    return {
+        "status": "ok",
+        "service": "tax-automator-agent",
+        "extraction_cache": runtime.extraction_cache.stats() if runtime else None,
+    }
 
 
-@app.post("/process_receipt")
-async def process_receipt(request: Request):
-    """Handles Firestore document-creation events forwarded by Eventarc."""
-    from google.cloud import firestore
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape endpoint."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-    PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator")
-    db = firestore.Client(project=PROJECT_ID)
 
-    logger.info("Received /process_receipt request")
+def parse_receipt_id(ce_subject: str) -> str:
+    """Extracts the receipt ID from a CloudEvent subject."""
+    if "/documents/receipts/" in ce_subject:
+        return ce_subject.split("/documents/receipts/")[1].split("/")[0]
+    return ce_subject.split("/")[-1]
 
-    ce_subject = request.headers.get("ce-subject")
-    if not ce_subject:
-        logger.warning("Missing ce-subject header")
-        return {"status": "ignored", "reason": "missing_subject"}
 
-    # Parse receipt ID from subject
+async def handle_receipt(receipt_id: str, event_id: str = None) -> dict:
+    """Runs the agent on one receipt and returns a per-receipt result."""
+    token = metrics.new_trace(event_id)
     try:
-        receipt_id = (
-            ce_subject.split("/documents/receipts/")[1].split("/")[0]
-            if "/documents/receipts/" in ce_subject
-            else ce_subject.split("/")[-1]
-        )
-    except Exception as e:
-        logger.error(f"Failed to parse subject: {e}")
-        return {"status": "error", "reason": "parse_error"}
+        with metrics.stage("total"):
+            result = await _handle_receipt(receipt_id, event_id)
+        result["trace_id"] = metrics.current_trace_id()
+    finally:
+        metrics.trace_id_var.reset(token)
+    metrics.RECEIPTS.labels(status=result["status"]).inc()
+    return result
 
-    logger.info(f"Processing receipt {receipt_id}")
 
-    # Fetch the Firestore document
-    doc_ref = db.collection("receipts").document(receipt_id)
-    doc = doc_ref.get()
+async def _handle_receipt(receipt_id: str, event_id: str = None) -> dict:
+    seen = runtime.recently_seen
 
-    if not doc.exists:
-        logger.error(f"Document {receipt_id} not found")
-        return {"status": "error", "reason": "not_found"}
+    # Drop redelivered events and receipts already in flight here without
+    # touching Firestore.
+    if event_id and seen.check_and_add(f"event:{event_id}"):
+        logger.info(f"Event {event_id} already handled, skipping")
+        return {"status": "skipped", "reason": "duplicate_event", "receipt_id": receipt_id}
+    if seen.check_and_add(f"receipt:{receipt_id}"):
+        logger.info(f"Receipt {receipt_id} recently claimed, skipping")
+        return {"status": "skipped", "reason": "duplicate_receipt", "receipt_id": receipt_id}
 
-    data = doc.to_dict()
-    if data.get("status") != "new":
-        logger.info(f"Document status is '{data.get('status')}', skipping")
-        return {"status": "skipped"}
+    try:
+        return await _process_receipt(receipt_id, event_id)
+    except Exception:
+        # Nothing recorded a final status, so a redelivery must be allowed
+        # to try again rather than be answered "skipped".
+        seen.discard(f"receipt:{receipt_id}")
+        if event_id:
+            seen.discard(f"event:{event_id}")
+        raise
 
-    # Mark as processing
-    doc_ref.update({"status": "processing"})
 
-    # Build the agent prompt
-    from google.genai import types
+async def _process_receipt(receipt_id: str, event_id: str = None) -> dict:
+    db = runtime.db
+    seen = runtime.recently_seen
+
+    logger.info(f"[{metrics.current_trace_id()}] Processing receipt {receipt_id}")
+
+    with metrics.stage("claim"):
+        outcome, data = await claim_receipt(db, receipt_id, event_id)
+
+    if outcome == "not_found":
+        logger.error(f"Document {receipt_id} not found")
+        # Let a later redelivery retry once the document is visible.
+        seen.discard(f"receipt:{receipt_id}")
+        if event_id:
+            seen.discard(f"event:{event_id}")
+        return {"status": "error", "reason": "not_found", "receipt_id": receipt_id}
+
+    if outcome == "skipped":
+        logger.info(f"Document status is '{data.get('status')}', skipping")
+        return {"status": "skipped", "receipt_id": receipt_id}
 
     image_uri = data.get("gcs_uri") or data.get("image_url")
     user_id = data.get("user_id")
+
+    # Replay a previous extraction of the exact same image instead of
+    # running the agent again.
+    cache_key = None
+    image_bytes = None
+    if image_uri and image_uri.startswith("gs://"):
+        try:
+            with metrics.stage("image_fetch"):
+                image_bytes = await asyncio.to_thread(runtime.download, image_uri)
+            cache_key = image_key(image_bytes)
+        except Exception as e:
+            logger.warning(f"Could not hash {image_uri}: {e}")
+
+    cached = None
+    if cache_key:
+        with metrics.stage("cache_lookup"):
+            cached = await runtime.extraction_cache.aget(cache_key)
+    if cached:
+        logger.info(f"Extraction cache hit for receipt {receipt_id}")
+        try:
+            message = await tools.store_receipt_to_firestore(
+                receipt_id=receipt_id,
+                date=cached["date"],
+                amount=cached["amount"],
+                category=cached.get("category", "Uncategorized"),
+                store=cached.get("store") or "Unknown Vendor",
+                user_id=user_id,
+            )
+            logger.info(message)
+            return {"status": "success", "receipt_id": receipt_id, "cached": True}
+        except Exception as e:
+            logger.error(f"Cached store failed, falling back to agent: {e}")
+
+    # Build the agent prompt
     prompt = f"Analyze the receipt with ID: {receipt_id}."
     
     parts = [types.Part.from_text(text=prompt)]
     
-    if image_uri and image_uri.startswith("gs://"):
+    if image_bytes is not None:
+        # Send a downscaled copy inline rather than the original upload
+        with metrics.stage("image_prep"):
+            prepared = await asyncio.to_thread(prepare_image, image_bytes)
+        parts.append(types.Part.from_bytes(data=prepared, mime_type="image/jpeg"))
+    elif image_uri and image_uri.startswith("gs://"):
         parts.append(types.Part.from_uri(file_uri=image_uri, mime_type="image/jpeg"))
     elif image_uri:
         prompt += f"\nThe receipt image is available at: {image_uri}"
@@ -81,43 +409,146 @@ async def process_receipt(request: Request):
     logger.info(f"Invoking agent for receipt {receipt_id}")
 
     try:
-        from google.adk.runners import Runner
-        from google.adk.sessions.in_memory_session_service import InMemorySessionService
-        from google.genai import types as genai_types
-        from agent import root_agent
-
-        session_service = InMemorySessionService()
-        runner = Runner(
-            agent=root_agent,
-            app_name="tax_automator",
-            session_service=session_service,
-        )
-
-        session = await session_service.create_session(
-            app_name="tax_automator",
-            user_id="system",
-        )
-
-        async for event in runner.run_async(
-            user_id="system",
-            session_id=session.id,
-            new_message=genai_types.Content(
-                role="user", parts=parts
-            ),
-        ):
-            if event.content and event.content.parts:
-                for part in event.content.parts:
-                    if part.text:
-                        logger.info(f"Agent: {part.text[:200]}")
+        await runtime.run(parts)
 
         # Finalise status
-        updated = doc_ref.get().to_dict()
+        with metrics.stage("doc_fetch"):
+            updated = await receipts_db.get_receipt(receipt_id)
+        if updated is None:
+            # Deleted while the agent ran, e.g. a duplicate removed from the dashboard
+            logger.info(f"Receipt {receipt_id} was deleted during processing")
+            return {"status": "skipped", "reason": "deleted", "receipt_id": receipt_id}
         if updated.get("status") == "processing":
-            doc_ref.update({"status": "completed"})
+            with metrics.stage("status_write"):
+                await receipts_db.update_receipt_tracked(receipt_id, {"status": "completed"})
+                if user_id:
+                    await receipts_db.receipts_changed(user_id)
+        elif cache_key:
+            await runtime.extraction_cache.aput(cache_key, updated)
 
         return {"status": "success", "receipt_id": receipt_id}
 
     except Exception as e:
         logger.error(f"Agent execution failed: {e}", exc_info=True)
-        doc_ref.update({"status": "failed", "error": str(e)})
-        raise HTTPException(status_code=500, detail=str(e))
+        try:
+            with metrics.stage("status_write"):
+                await receipts_db.update_receipt_tracked(receipt_id, {"status": "failed", "error": str(e)})
+        except NotFound:
+            logger.info(f"Receipt {receipt_id} was deleted during processing")
+            return {"status": "skipped", "reason": "deleted", "receipt_id": receipt_id}
+        return {"status": "failed", "receipt_id": receipt_id, "error": str(e)}
+
+
+@app.post("/process_receipt")
+async def process_receipt(request: Request):
+    """Handles Firestore document-creation events forwarded by Eventarc."""
+    logger.info("Received /process_receipt request")
+
+    ce_subject = request.headers.get("ce-subject")
+    if not ce_subject:
+        logger.warning("Missing ce-subject header")
+        return {"status": "ignored", "reason": "missing_subject"}
+
+    # Parse receipt ID from subject
+    try:
+        receipt_id = parse_receipt_id(ce_subject)
+    except Exception as e:
+        logger.error(f"Failed to parse subject: {e}")
+        return {"status": "error", "reason": "parse_error"}
+
+    result = await handle_receipt(receipt_id, request.headers.get("ce-id"))
+    if result["status"] == "failed":
+        raise HTTPException(status_code=500, detail=result["error"])
+    if result["status"] == "error":
+        return {"status": "error", "reason": result["reason"]}
+    if result["status"] == "skipped":
+        return {"status": "skipped"}
+    return result
+
+
+@app.post("/process_receipts", status_code=202)
+async def process_receipts(batch: BatchRequest):
+    """Queues many receipts at once on the shared work queue.
+
+    Returns immediately with a batch ID; poll /process_receipts/{batch_id}
+    for per-receipt results.
+    """
+    receipt_ids = list(dict.fromkeys(batch.receipt_ids))
+    if len(receipt_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large ({len(receipt_ids)} > {MAX_BATCH_SIZE})",
+        )
+
+    logger.info(f"Received batch of {len(receipt_ids)} receipts")
+
+    if not queue.has_room(len(receipt_ids)):
+        raise HTTPException(status_code=429, detail="Receipt queue is full, retry later")
+    tracked = Batch(receipt_ids)
+    if not track_batch(tracked):
+        raise HTTPException(status_code=429, detail="Too many batches in progress, retry later")
+    for receipt_id in receipt_ids:
+        tracked.watch(receipt_id, queue.submit(receipt_id))
+
+    return {
+        "status": "accepted",
+        "batch_id": tracked.id,
+        "receipt_count": len(receipt_ids),
+        "results_url": f"/process_receipts/{tracked.id}",
+    }
+
+
+@app.get("/process_receipts/{batch_id}")
+async def batch_results(batch_id: str):
+    """Progress and per-receipt results of a batch, in submission order."""
+    tracked = batches.get(batch_id)
+    if tracked is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch: {batch_id}")
+    return tracked.view()
+
+
+async def authenticated_uid(request: Request) -> str:
+    """Returns the UID from the request's Firebase ID token, or raises 401."""
+    import firebase_admin
+    from firebase_admin import auth
+
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app()
+    try:
+        claims = await asyncio.to_thread(auth.verify_id_token, header[len("Bearer "):])
+    except Exception as e:
+        logger.warning(f"Rejected export token: {e}")
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return claims["uid"]
+
+
+@app.get("/export")
+async def export_receipts(
+    request: Request,
+    format: str = "csv",
+    year: Optional[int] = None,
+    status: Optional[str] = None,
+    subtotals: bool = True,
+):
+    """Streams the caller's receipts as CSV or Parquet, with category subtotals."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    user_id = await authenticated_uid(request)
+
+    media_type, extension = EXPORT_FORMATS[format]
+    rows = export.iter_receipts(runtime.db, user_id, year, status)
+    if format == "csv":
+        body = export.csv_stream(rows, subtotals)
+    else:
+        body = export.parquet_stream(rows)
+
+    filename = f"tax-receipts-{year or 'all'}{'-' + status if status else ''}.{extension}"
+    logger.info(f"Exporting receipts for {user_id} as {format} (year={year}, status={status})")
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,121 @@
+"""Throughput vs. concurrency for the receipt pipeline's Firestore I/O.
+
+Replays the Firestore calls made for one receipt (fetch, duplicate scan,
+status update) N times at several concurrency levels, once with the sync
+client called from async handlers (the old behaviour, which blocks the event
+loop) and once with the AsyncClient used by receipts_db.
+
+Runs against whatever FIRESTORE_EMULATOR_HOST / GOOGLE_CLOUD_PROJECT point
+at, using a throwaway collection:
+
+    gcloud emulators firestore start --host-port=localhost:8681
+    FIRESTORE_EMULATOR_HOST=localhost:8681 python benchmarks/firestore_concurrency.py
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+
+from google.cloud import firestore
+
+PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator")
+COLLECTION = f"bench_receipts_{uuid.uuid4().hex[:8]}"
+USER_ID = "bench-user"
+DATE = "2025-01-15"
+
+
+def seed(db: firestore.Client, count: int) -> list:
+    ids = []
+    batch = db.batch()
+    for i in range(count):
+        ref = db.collection(COLLECTION).document()
+        batch.set(ref, {
+            "user_id": USER_ID,
+            "date": DATE,
+            "store": f"Store {i % 10}",
+            "amount": float(i),
+            "status": "new",
+        })
+        ids.append(ref.id)
+        if i % 400 == 399:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    return ids
+
+
+def cleanup(db: firestore.Client, ids: list):
+    batch = db.batch()
+    for i, receipt_id in enumerate(ids):
+        batch.delete(db.collection(COLLECTION).document(receipt_id))
+        if i % 400 == 399:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+
+async def sync_receipt(db: firestore.Client, receipt_id: str):
+    ref = db.collection(COLLECTION).document(receipt_id)
+    ref.get()
+    query = db.collection(COLLECTION).where("user_id", "==", USER_ID).where("date", "==", DATE)
+    for _ in query.stream():
+        pass
+    ref.update({"status": "processed"})
+
+
+async def async_receipt(db: firestore.AsyncClient, receipt_id: str):
+    ref = db.collection(COLLECTION).document(receipt_id)
+    await ref.get()
+    query = db.collection(COLLECTION).where("user_id", "==", USER_ID).where("date", "==", DATE)
+    async for _ in query.stream():
+        pass
+    await ref.update({"status": "processed"})
+
+
+async def run(handler, db, ids: list, concurrency: int) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(receipt_id):
+        async with slots:
+            start = time.perf_counter()
+            await handler(db, receipt_id)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(receipt_id) for receipt_id in ids))
+    elapsed = time.perf_counter() - start
+    return {
+        "throughput": len(ids) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+    }
+
+
+async def main(args):
+    sync_db = firestore.Client(project=PROJECT_ID)
+    async_db = firestore.AsyncClient(project=PROJECT_ID)
+    ids = seed(sync_db, args.receipts)
+    try:
+        print(f"{'concurrency':>11}  {'mode':>5}  {'receipts/s':>10}  {'p50 ms':>8}")
+        for concurrency in args.concurrency:
+            for mode, handler, db in (
+                ("sync", sync_receipt, sync_db),
+                ("async", async_receipt, async_db),
+            ):
+                result = await run(handler, db, ids, concurrency)
+                print(
+                    f"{concurrency:>11}  {mode:>5}  "
+                    f"{result['throughput']:>10.1f}  {result['p50_ms']:>8.1f}"
+                )
+    finally:
+        cleanup(sync_db, ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    asyncio.run(main(parser.parse_args()))
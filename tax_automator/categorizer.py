@@ -0,0 +1,70 @@
+"""Keyword-based IRS tax categorization.
+
+Rules live in tax_rules.json as an ordered list of categories and keywords.
+They are compiled into one regular expression with a named group per
+category. Keywords match whole words (plus a plural "s"/"es"), and when
+several categories match, the one listed first wins.
+"""
+
+import json
+import os
+import re
+from typing import Iterable, List
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tax_rules.json")
+
+
+class Categorizer:
+    """Compiled matcher for an ordered list of category rules."""
+
+    def __init__(self, rules: List[dict], default: str = "Uncategorized"):
+        self.default = default
+        self.categories = [rule["category"] for rule in rules]
+
+        groups = []
+        for index, rule in enumerate(rules):
+            keywords = sorted(rule["keywords"], key=len, reverse=True)
+            alternatives = "|".join(
+                r"\s+".join(re.escape(word) for word in keyword.split())
+                for keyword in keywords
+            )
+            groups.append(rf"(?P<c{index}>\b(?:{alternatives})(?:e?s)?\b)")
+        self._pattern = re.compile("|".join(groups), re.IGNORECASE)
+
+    @classmethod
+    def from_file(cls, path: str = RULES_PATH) -> "Categorizer":
+        with open(path, "r") as f:
+            config = json.load(f)
+        return cls(config["rules"], config.get("default", "Uncategorized"))
+
+    def categorize(self, description: str) -> str:
+        best = None
+        for match in self._pattern.finditer(description or ""):
+            index = int(match.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        return self.default if best is None else self.categories[best]
+
+    def categorize_many(self, descriptions: Iterable[str]) -> List[str]:
+        """Categorizes many descriptions, e.g. to re-classify a user's history."""
+        return [self.categorize(description) for description in descriptions]
+
+
+_categorizer: Categorizer = None
+
+
+def get_categorizer() -> Categorizer:
+    global _categorizer
+    if _categorizer is None:
+        _categorizer = Categorizer.from_file()
+    return _categorizer
+
+
+def categorize(description: str) -> str:
+    return get_categorizer().categorize(description)
+
+
+def categorize_many(descriptions: Iterable[str]) -> List[str]:
+    return get_categorizer().categorize_many(descriptions)
@@ -0,0 +1,180 @@
+"""Streaming year-end receipt export as CSV or Parquet.
+
+Receipts are read from Firestore a page at a time with query cursors and
+written out as they arrive. The only state kept across pages is the
+per-category subtotals, so memory stays flat however many receipts a
+user has. Only receipts with a date are exported, ordered by date.
+"""
+
+import csv
+import io
+import json
+from typing import AsyncIterator, Optional
+
+from google.cloud import firestore
+
+COLUMNS = ("id", "date", "store", "vendor_key", "amount", "category", "status")
+PAGE_SIZE = 500
+CSV_CHUNK_BYTES = 64 * 1024
+
+
+async def iter_receipts(
+    db: firestore.AsyncClient,
+    user_id: str,
+    year: Optional[int] = None,
+    status: Optional[str] = None,
+    page_size: int = PAGE_SIZE,
+) -> AsyncIterator[dict]:
+    """Yields the user's receipts as export rows, ordered by date."""
+    query = db.collection("receipts").where("user_id", "==", user_id)
+    if status:
+        query = query.where("status", "==", status)
+    if year:
+        query = query.where("date", ">=", f"{year}-01-01").where("date", "<=", f"{year}-12-31")
+    query = query.order_by("date")
+
+    cursor = None
+    while True:
+        page = query.start_after(cursor) if cursor else query
+        docs = [doc async for doc in page.limit(page_size).stream()]
+        for doc in docs:
+            data = doc.to_dict()
+            yield {
+                "id": doc.id,
+                "date": data.get("date"),
+                "store": data.get("store"),
+                "vendor_key": data.get("vendor_key"),
+                "amount": float(data.get("amount") or 0),
+                "category": data.get("category") or "Uncategorized",
+                "status": data.get("status"),
+            }
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1]
+
+
+class Subtotals:
+    """Running count and total per category."""
+
+    def __init__(self):
+        self.categories = {}
+
+    def add(self, row: dict):
+        entry = self.categories.setdefault(row["category"], {"count": 0, "total": 0.0})
+        entry["count"] += 1
+        entry["total"] += row["amount"]
+
+    def rows(self) -> list:
+        return [
+            {"category": category, "count": entry["count"], "total": round(entry["total"], 2)}
+            for category, entry in sorted(self.categories.items())
+        ]
+
+    @property
+    def count(self) -> int:
+        return sum(entry["count"] for entry in self.categories.values())
+
+    @property
+    def grand_total(self) -> float:
+        return round(sum(entry["total"] for entry in self.categories.values()), 2)
+
+
+async def csv_stream(rows: AsyncIterator[dict], subtotals: bool = True) -> AsyncIterator[bytes]:
+    """Encodes rows as CSV in chunks of about CSV_CHUNK_BYTES.
+
+    With `subtotals`, a category summary section follows the receipts after
+    a blank line.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    totals = Subtotals()
+    writer.writerow(COLUMNS)
+    async for row in rows:
+        totals.add(row)
+        writer.writerow([
+            f"{row[column]:.2f}" if column == "amount" else row[column] or ""
+            for column in COLUMNS
+        ])
+        if buffer.tell() >= CSV_CHUNK_BYTES:
+            yield take()
+
+    if subtotals:
+        writer.writerow([])
+        writer.writerow(["category", "count", "total"])
+        for entry in totals.rows():
+            writer.writerow([entry["category"], entry["count"], f"{entry['total']:.2f}"])
+        writer.writerow(["TOTAL", totals.count, f"{totals.grand_total:.2f}"])
+    yield take()
+
+
+class _ChunkSink:
+    """Write-only file object that hands back what was written since the last take()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def parquet_stream(rows: AsyncIterator[dict], page_size: int = PAGE_SIZE) -> AsyncIterator[bytes]:
+    """Encodes rows as Parquet, one row group per page of receipts.
+
+    Category subtotals are stored as JSON under the "category_subtotals"
+    key of the file metadata, since it is only written with the footer.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.string()),
+        ("date", pa.string()),
+        ("store", pa.string()),
+        ("vendor_key", pa.string()),
+        ("amount", pa.float64()),
+        ("category", pa.string()),
+        ("status", pa.string()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    totals = Subtotals()
+    page = []
+
+    async for row in rows:
+        totals.add(row)
+        page.append(row)
+        if len(page) >= page_size:
+            writer.write_table(pa.Table.from_pylist(page, schema=schema))
+            page = []
+            yield sink.take()
+
+    if page:
+        writer.write_table(pa.Table.from_pylist(page, schema=schema))
+    writer.add_key_value_metadata({"category_subtotals": json.dumps(totals.rows())})
+    writer.close()
+    yield sink.take()
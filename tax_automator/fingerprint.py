@@ -0,0 +1,208 @@
+"""Receipt fingerprint index for O(1) duplicate detection.
+
+A fingerprint is a hash of the owner, canonical vendor key (see vendors.py),
+date and amount.
+Each one is stored as a document in `receipt_fingerprints` pointing at the
+receipt that claimed it, and is written in the same transaction as the
+receipt and its spending rollup. A duplicate check is therefore one point
+lookup instead of a scan over the user's receipts for that day.
+
+The receipt keeps the ID of its fingerprint in `fingerprint`. When an
+update changes the store, date or amount, the old fingerprint is deleted in
+the same transaction. A fingerprint only counts as taken while its receipt
+exists and that receipt's current values still hash to it, so one left
+behind by an edit made elsewhere (e.g. in the dashboard) is taken over.
+"""
+
+import hashlib
+from typing import Optional
+
+from google.cloud import firestore
+
+from rollups import apply_rollup, apply_rollups
+
+FINGERPRINT_COLLECTION = "receipt_fingerprints"
+
+
+def receipt_fingerprint(user_id: str, vendor_key: str, date: str, amount) -> str:
+    key = f"{user_id}|{vendor_key}|{(date or '').strip()}|{float(amount):.2f}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def current_fingerprint(data: Optional[dict]) -> Optional[str]:
+    """The fingerprint a receipt's current values hash to, or None if it has none."""
+    if not data or data.get("amount") is None:
+        return None
+    try:
+        return receipt_fingerprint(data.get("user_id"), data.get("vendor_key"), data.get("date"), data.get("amount"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _owns(snapshot, fingerprint: str) -> bool:
+    return snapshot.exists and current_fingerprint(snapshot.to_dict()) == fingerprint
+
+
+def _stale_fingerprint(old: Optional[dict], fingerprint: str) -> Optional[str]:
+    """The fingerprint the receipt held before this write, if it is being replaced."""
+    previous = (old or {}).get("fingerprint") or current_fingerprint(old)
+    return previous if previous and previous != fingerprint else None
+
+
+def _fingerprint_doc(user_id: str, receipt_id: str) -> dict:
+    return {
+        "receipt_id": receipt_id,
+        "user_id": user_id,
+        "created_at": firestore.SERVER_TIMESTAMP,
+    }
+
+
+def _write_receipt(transaction, db, receipt_ref, old: Optional[dict], fields: dict, create: bool, stale=None):
+    if stale is not None and stale.exists and stale.get("receipt_id") == receipt_ref.id:
+        transaction.delete(stale.reference)
+    if create:
+        transaction.set(receipt_ref, fields)
+    else:
+        transaction.update(receipt_ref, fields)
+    apply_rollup(transaction, db, old, {**(old or {}), **fields})
+
+
+def record_receipt(
+    db: firestore.Client,
+    receipt_ref,
+    user_id: str,
+    vendor_key: str,
+    date: str,
+    amount,
+    fields: dict,
+    create: bool = False,
+) -> Optional[str]:
+    """Writes `fields` to the receipt and claims its fingerprint atomically.
+
+    The user's spending rollup is updated in the same transaction. Returns the ID of the receipt that already owns the fingerprint, in which
+    case nothing is written. A fingerprint whose receipt has since been
+    deleted is taken over.
+    """
+    fp_ref = db.collection(FINGERPRINT_COLLECTION).document(
+        receipt_fingerprint(user_id, vendor_key, date, amount)
+    )
+
+    fields = {**fields, "fingerprint": fp_ref.id}
+
+    @firestore.transactional
+    def _record(transaction):
+        snapshot = fp_ref.get(transaction=transaction)
+        if snapshot.exists:
+            original_id = snapshot.get("receipt_id")
+            if original_id != receipt_ref.id:
+                original = receipt_ref.parent.document(original_id).get(transaction=transaction)
+                if _owns(original, fp_ref.id):
+                    return original_id
+        old = None
+        stale = None
+        if not create:
+            current = receipt_ref.get(transaction=transaction)
+            old = current.to_dict() if current.exists else None
+            stale_id = _stale_fingerprint(old, fp_ref.id)
+            if stale_id:
+                stale = db.collection(FINGERPRINT_COLLECTION).document(stale_id).get(transaction=transaction)
+        transaction.set(fp_ref, _fingerprint_doc(user_id, receipt_ref.id))
+        _write_receipt(transaction, db, receipt_ref, old, fields, create, stale)
+        return None
+
+    return _record(db.transaction())
+
+
+def record_new_receipts(db: firestore.Client, entries) -> list:
+    """Creates several receipts, e.g. a Telegram album, in one transaction.
+
+    `entries` is a list of `(receipt_ref, user_id, vendor_key, date, amount,
+    fields)` tuples. Returns, per entry, the ID of the receipt it duplicates
+    (possibly an earlier entry in the same batch) or None if it was written.
+    """
+    fp_refs = [
+        db.collection(FINGERPRINT_COLLECTION).document(
+            receipt_fingerprint(user_id, vendor_key, date, amount)
+        )
+        for _, user_id, vendor_key, date, amount, _ in entries
+    ]
+
+    @firestore.transactional
+    def _record(transaction):
+        owners = {}
+        for snapshot in transaction.get_all(list({ref.path: ref for ref in fp_refs}.values())):
+            if snapshot.exists:
+                owners[snapshot.reference.path] = snapshot.get("receipt_id")
+
+        receipts = entries[0][0].parent if entries else None
+        # Owners that still exist and still hash to the fingerprint pointing at them
+        live = set()
+        if owners:
+            original_refs = [receipts.document(receipt_id) for receipt_id in set(owners.values())]
+            fingerprints = {}
+            for path, receipt_id in owners.items():
+                fingerprints.setdefault(receipt_id, set()).add(path.rsplit("/", 1)[-1])
+            live = {
+                snap.id for snap in transaction.get_all(original_refs)
+                if snap.exists and current_fingerprint(snap.to_dict()) in fingerprints[snap.id]
+            }
+
+        results = []
+        changes = []
+        for (receipt_ref, user_id, _, _, _, fields), fp_ref in zip(entries, fp_refs):
+            owner = owners.get(fp_ref.path)
+            if owner is not None and owner in live:
+                results.append(owner)
+                continue
+            owners[fp_ref.path] = receipt_ref.id
+            live.add(receipt_ref.id)
+            fields = {**fields, "fingerprint": fp_ref.id}
+            transaction.set(fp_ref, _fingerprint_doc(user_id, receipt_ref.id))
+            transaction.set(receipt_ref, fields)
+            changes.append((None, fields))
+            results.append(None)
+        apply_rollups(transaction, db, changes)
+        return results
+
+    return _record(db.transaction())
+
+
+async def arecord_receipt(
+    db: firestore.AsyncClient,
+    receipt_ref,
+    user_id: str,
+    vendor_key: str,
+    date: str,
+    amount,
+    fields: dict,
+    create: bool = False,
+) -> Optional[str]:
+    """Like `record_receipt`, for a Firestore AsyncClient."""
+    fp_ref = db.collection(FINGERPRINT_COLLECTION).document(
+        receipt_fingerprint(user_id, vendor_key, date, amount)
+    )
+
+    fields = {**fields, "fingerprint": fp_ref.id}
+
+    @firestore.async_transactional
+    async def _record(transaction):
+        snapshot = await fp_ref.get(transaction=transaction)
+        if snapshot.exists:
+            original_id = snapshot.get("receipt_id")
+            if original_id != receipt_ref.id:
+                original = await receipt_ref.parent.document(original_id).get(transaction=transaction)
+                if _owns(original, fp_ref.id):
+                    return original_id
+        old = None
+        stale = None
+        if not create:
+            current = await receipt_ref.get(transaction=transaction)
+            old = current.to_dict() if current.exists else None
+            stale_id = _stale_fingerprint(old, fp_ref.id)
+            if stale_id:
+                stale = await db.collection(FINGERPRINT_COLLECTION).document(stale_id).get(transaction=transaction)
+        transaction.set(fp_ref, _fingerprint_doc(user_id, receipt_ref.id))
+        _write_receipt(transaction, db, receipt_ref, old, fields, create, stale)
+        return None
+
+    return await _record(db.transaction())
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+
+from google.cloud import firestore
+
+
+class RecentlySeen:
+    """Bounded in-process set of keys that expire after `ttl` seconds.
+
+    Lets redelivered events be rejected without a Firestore round trip. The
+    oldest entries are evicted first once `max_size` is reached.
+    """
+
+    def __init__(self, ttl: float = 600.0, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._entries:
+            key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        """Returns True if `key` was added and has not expired yet."""
+        expires_at = self._entries.get(key)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def add(self, key: str):
+        now = time.monotonic()
+        self._entries.pop(key, None)
+        self._entries[key] = now + self.ttl
+        self._evict(now)
+
+    def check_and_add(self, key: str) -> bool:
+        """Marks `key` as seen and returns whether it had already been seen."""
+        if self.seen(key):
+            return True
+        self.add(key)
+        return False
+
+    def discard(self, key: str):
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+async def claim_receipt(db: firestore.AsyncClient, receipt_id: str, event_id: str = None):
+    """Atomically moves a receipt from 'new' to 'processing'.
+
+    Returns a `(outcome, data)` tuple where outcome is 'claimed', 'skipped'
+    (the receipt is no longer 'new') or 'not_found'. Only one concurrent
+    caller can ever get 'claimed' for the same receipt.
+    """
+    doc_ref = db.collection("receipts").document(receipt_id)
+
+    @firestore.async_transactional
+    async def _claim(transaction):
+        snapshot = await doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return "not_found", None
+        data = snapshot.to_dict()
+        if data.get("status") != "new":
+            return "skipped", data
+        transaction.update(doc_ref, {
+            "status": "processing",
+            "claim_event_id": event_id,
+            "claimed_at": firestore.SERVER_TIMESTAMP,
+        })
+        return "claimed", data
+
+    return await _claim(db.transaction())
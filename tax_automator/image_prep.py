@@ -0,0 +1,109 @@
+"""Receipt image preprocessing before extraction.
+
+Shrinks what is sent to Gemini without losing what it needs to read: picks
+a large-enough source, decodes at reduced size where JPEG allows, crops the
+table/background around the receipt, drops colour when the receipt has
+none, and re-encodes to a bounded-resolution JPEG.
+"""
+
+import io
+import logging
+import os
+
+from PIL import Image, ImageChops, ImageOps
+
+logger = logging.getLogger(__name__)
+
+MAX_SIDE = int(os.environ.get("RECEIPT_MAX_SIDE", "1600"))
+JPEG_QUALITY = int(os.environ.get("RECEIPT_JPEG_QUALITY", "85"))
+# Smallest photo side worth downloading. Telegram's largest size is usually
+# 1280px, so this must stay below that to ever skip the full-size download.
+MIN_PHOTO_SIDE = int(os.environ.get("RECEIPT_MIN_PHOTO_SIDE", "1024"))
+
+# Corner-colour difference above which a pixel counts as receipt content
+_BORDER_THRESHOLD = 40
+# Only crop when the border is at least this share of the area
+_MIN_CROP_GAIN = 0.1
+# Mean HSV saturation (0-255) below which the image is treated as greyscale
+_GRAYSCALE_SATURATION = 40
+
+
+def pick_photo_size(sizes, min_side: int = MIN_PHOTO_SIDE):
+    """Returns the smallest Telegram PhotoSize whose longer side is >= min_side.
+
+    Falls back to the largest size when none is big enough.
+    """
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= min_side:
+            return size
+    return ordered[-1]
+
+
+def _crop_border(img: Image.Image) -> Image.Image:
+    gray = img.convert("L")
+    width, height = gray.size
+    corners = [gray.getpixel(xy) for xy in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))]
+    background = sorted(corners)[1:3]
+    background = sum(background) // 2
+
+    diff = ImageChops.difference(gray, Image.new("L", gray.size, background))
+    bbox = diff.point(lambda p: 255 if p > _BORDER_THRESHOLD else 0).getbbox()
+    if not bbox:
+        return img
+
+    left, top, right, bottom = bbox
+    margin = max(width, height) // 100
+    bbox = (max(0, left - margin), max(0, top - margin), min(width, right + margin), min(height, bottom + margin))
+    cropped_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    if cropped_area > (1 - _MIN_CROP_GAIN) * width * height:
+        return img
+    return img.crop(bbox)
+
+
+def _is_grayscale(img: Image.Image) -> bool:
+    sample = img.copy()
+    sample.thumbnail((128, 128))
+    saturation = sample.convert("HSV").getchannel("S")
+    pixels = saturation.getdata()
+    return sum(pixels) / len(pixels) < _GRAYSCALE_SATURATION
+
+
+def preprocess(source, max_side: int = MAX_SIDE, quality: int = JPEG_QUALITY) -> bytes:
+    """Returns a downscaled, cropped JPEG of `source`.
+
+    `source` is bytes or a binary file object; pass a BytesIO to avoid
+    copying a downloaded buffer.
+    """
+    if hasattr(source, "seek"):
+        source.seek(0)
+    else:
+        source = io.BytesIO(source)
+
+    img = Image.open(source)
+    # Let the JPEG decoder skip detail we are going to throw away anyway
+    img.draft("RGB", (max_side, max_side))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+
+    img = _crop_border(img)
+    if _is_grayscale(img):
+        img = img.convert("L")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def prepare_image(source) -> bytes:
+    """Like `preprocess`, but falls back to the original bytes on failure."""
+    try:
+        return preprocess(source)
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed, sending original: {e}")
+        if hasattr(source, "getvalue"):
+            return source.getvalue()
+        if hasattr(source, "seek"):
+            source.seek(0)
+            return source.read()
+        return bytes(source)
@@ -0,0 +1,98 @@
+"""Stage-level latency metrics for the receipt pipeline.
+
+Histograms are exported in Prometheus text format on /metrics. Every receipt
+run gets a trace ID (the CloudEvent ce-id when there is one) held in a
+context variable, so agent tool calls can be tied back to their receipt.
+"""
+
+import functools
+import inspect
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "receipt_stage_seconds",
+    "Time spent in each stage of receipt processing.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+TOOL_CALLS = Counter(
+    "agent_tool_calls_total",
+    "Agent tool invocations by outcome.",
+    ["tool", "outcome"],
+)
+RECEIPTS = Counter(
+    "receipts_processed_total",
+    "Receipts handled, by final result status.",
+    ["status"],
+)
+
+trace_id_var: ContextVar = ContextVar("trace_id", default=None)
+
+
+def new_trace(event_id: str = None):
+    """Starts a trace for the current receipt and returns the reset token."""
+    return trace_id_var.set(event_id or uuid.uuid4().hex)
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get() or "-"
+
+
+@contextmanager
+def stage(name: str):
+    """Times the enclosed block into the `name` stage histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        logger.debug(f"[{current_trace_id()}] {name} took {elapsed * 1000:.1f}ms")
+
+
+def timed_tool(func):
+    """Records a `tool:<name>` stage and outcome counter around an agent tool.
+
+    The wrapper keeps the tool's signature and docstring, which ADK uses to
+    build the function declaration.
+    """
+    name = func.__name__
+
+    def _record(start, outcome):
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage=f"tool:{name}").observe(elapsed)
+        TOOL_CALLS.labels(tool=name, outcome=outcome).inc()
+        logger.info(f"[{current_trace_id()}] tool {name} {outcome} in {elapsed * 1000:.1f}ms")
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                _record(start, "error")
+                raise
+            _record(start, "ok")
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _record(start, "error")
+            raise
+        _record(start, "ok")
+        return result
+    return wrapper
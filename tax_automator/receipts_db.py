@@ -0,0 +1,77 @@
+"""Async Firestore access for the tax automator service.
+
+All receipt reads and writes made by app.py and the agent tools go through
+here, so a slow Firestore round trip only suspends the receipt waiting on it
+instead of blocking the uvicorn event loop.
+"""
+
+import os
+from typing import Optional
+
+from google.cloud import firestore
+
+from fingerprint import arecord_receipt
+from query_cache import abump_generation
+from rollups import aupdate_receipt_tracked
+from vendors import VendorTable
+
+PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator")
+
+_client: firestore.AsyncClient = None
+_vendors: VendorTable = None
+
+
+def get_db() -> firestore.AsyncClient:
+    """Returns the process-wide async client, creating it on first use.
+
+    Must be called from inside the running event loop the client will be
+    used on.
+    """
+    global _client
+    if _client is None:
+        _client = firestore.AsyncClient(project=PROJECT_ID)
+    return _client
+
+
+async def vendor_key(store: str) -> str:
+    """Returns the canonical vendor key for a raw store name."""
+    global _vendors
+    if _vendors is None:
+        _vendors = VendorTable(get_db())
+    return await _vendors.acanonical(store)
+
+
+def receipt_ref(receipt_id: str) -> firestore.AsyncDocumentReference:
+    return get_db().collection("receipts").document(receipt_id)
+
+
+async def get_receipt(receipt_id: str) -> Optional[dict]:
+    """Returns the receipt's fields, or None if it does not exist."""
+    doc = await receipt_ref(receipt_id).get()
+    return doc.to_dict() if doc.exists else None
+
+
+async def update_receipt_tracked(receipt_id: str, fields: dict):
+    """Updates a receipt and the user's spending rollup in one transaction.
+
+    Any status or amount change can move a receipt in or out of the rollup,
+    so every receipt update goes through here.
+    """
+    await aupdate_receipt_tracked(get_db(), receipt_ref(receipt_id), fields)
+
+
+async def record_receipt(
+    receipt_id: str, user_id: str, vendor_key: str, date: str, amount: float, fields: dict
+) -> Optional[str]:
+    """Updates the receipt unless its fingerprint is taken by another receipt.
+
+    Returns the ID of the original receipt when this one is a duplicate.
+    """
+    return await arecord_receipt(
+        get_db(), receipt_ref(receipt_id), user_id, vendor_key, date, amount, fields
+    )
+
+
+async def receipts_changed(user_id: str):
+    """Invalidates the Telegram bot's cached tool results for the user."""
+    await abump_generation(get_db(), user_id)
@@ -1,15 +1,12 @@
-import firebase_admin
-from firebase_admin import firestore
 from typing import Optional
-import hashlib
 
-# Initialize Firestore
-if not firebase_admin._apps:
-    firebase_admin.initialize_app()
-db = firestore.client()
+import receipts_db
+from categorizer import categorize
+from metrics import stage, timed_tool
 
 
-def store_receipt_to_firestore(
+@timed_tool
+async def store_receipt_to_firestore(
     receipt_id: str,
     date: str,
     amount: float,
@@ -33,46 +30,34 @@ def store_receipt_to_firestore(
     Returns:
         The ID of the updated document in Firestore.
     """
-    doc_ref = db.collection('receipts').document(receipt_id)
-    
-    # Check for duplicate receipts
-    if user_id:
-        existing_docs = db.collection('receipts') \
-            .where('user_id', '==', user_id) \
-            .where('date', '==', date) \
-            .stream()
-        
-        for doc in existing_docs:
-            if doc.id == receipt_id:
-                continue
-            doc_data = doc.to_dict()
-            # Avoid ValueError on casting amount if it's missing/bad
-            try:
-                existing_amount = float(doc_data.get('amount', 0))
-                current_amount = float(amount)
-            except (ValueError, TypeError):
-                continue
-                
-            if existing_amount == current_amount and doc_data.get('store', '').lower() == store.lower():
-                doc_ref.update({
-                    'status': 'duplicate',
-                    'store': store,
-                    'date': date,
-                    'amount': amount,
-                    'category': category
-                })
-                return f"Duplicate receipt detected. Handled as 'duplicate'. Original ID: {doc.id}"
-
-    doc_ref.update({
+    vendor_key = await receipts_db.vendor_key(store)
+    fields = {
         'store': store,
+        'vendor_key': vendor_key,
         'date': date,
         'amount': amount,
         'category': category,
         'status': 'processed' if float(amount) < 500 else 'needs_approval'
-    })
-    return f"Receipt updated successfully with ID: {doc_ref.id}"
+    }
+
+    # Check for duplicate receipts
+    if user_id:
+        with stage("duplicate_check"):
+            duplicate_id = await receipts_db.record_receipt(
+                receipt_id, user_id, vendor_key, date, amount, fields
+            )
+        if duplicate_id:
+            await receipts_db.update_receipt_tracked(receipt_id, {**fields, 'status': 'duplicate'})
+        await receipts_db.receipts_changed(user_id)
+        if duplicate_id:
+            return f"Duplicate receipt detected. Handled as 'duplicate'. Original ID: {duplicate_id}"
+    else:
+        await receipts_db.update_receipt_tracked(receipt_id, fields)
+
+    return f"Receipt updated successfully with ID: {receipt_id}"
 
 
+@timed_tool
 def tax_categorizer(item_description: str, amount: float) -> str:
     """
     Assigns an IRS tax category based on the item description and amount.
@@ -84,20 +69,4 @@ def tax_categorizer(item_description: str, amount: float) -> str:
     Returns:
         The suggested IRS tax category.
     """
-    description = item_description.lower()
-    
-    # Simple keyword-based categorization logic
-    if any(keyword in description for keyword in ['gas', 'fuel', 'oil change', 'car wash']):
-        return "Auto Expenses"
-    elif any(keyword in description for keyword in ['meal', 'lunch', 'dinner', 'restaurant', 'coffee']):
-        return "Meals" # Note: 50% deductible usually
-    elif any(keyword in description for keyword in ['hotel', 'flight', 'airbnb', 'uber', 'lyft']):
-        return "Travel"
-    elif any(keyword in description for keyword in ['laptop', 'monitor', 'keyboard', 'mouse', 'software', 'office']):
-        return "Office Supplies"
-    elif any(keyword in description for keyword in ['internet', 'phone', 'utility', 'electricity']):
-        return "Utilities"
-    elif any(keyword in description for keyword in ['legal', 'consulting', 'accounting']):
-        return "Professional Services"
-    
-    return "Uncategorized"
+    return categorize(item_description)
@@ -0,0 +1,300 @@
+"""In-process SQLite mirror of the receipts collection for chat analytics.
+
+A Firestore listener on `receipts` loads every receipt once at startup
+and then applies each add, change and delete as it happens. Spending
+summaries, recent receipts and group-bys over category, month and vendor
+then run as indexed SQL against local memory instead of Firestore
+queries. Until the first snapshot has been applied, `ready` is False and
+callers should use Firestore directly.
+
+The listener can die, e.g. after a stream error it gives up on, and then
+the mirror silently stops changing. `ready` therefore also requires the
+listener to be active and, with `max_staleness` set, a snapshot within
+that many seconds. Firestore only sends snapshots when receipts change, so
+the staleness bound is meant for collections that are written steadily.
+When either check fails, `ready` turns False and the listener is replaced,
+at most once per `restart_interval`. The new listener reloads the table.
+
+Every bot instance keeps its own mirror, so the initial load costs one
+read per receipt per instance start. It is enabled with ANALYTICS_MIRROR=1.
+A full rebuild is a paginated scan of the collection; the same code backs
+a reporting CLI:
+
+    python analytics_mirror.py --user UID [--group-by category,month] [--start 2025-01-01] [--end 2025-12-31]
+"""
+
+import argparse
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from rollups import COUNTED_STATUSES
+
+logger = logging.getLogger(__name__)
+
+_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Group-by dimension -> column
+DIMENSIONS = {"category": "category", "month": "month", "vendor": "vendor_key"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    date TEXT,
+    month TEXT,
+    store TEXT,
+    vendor_key TEXT,
+    amount REAL,
+    category TEXT,
+    status TEXT,
+    created_at REAL
+);
+-- Covers summary and group-by queries without touching the table
+CREATE INDEX IF NOT EXISTS receipts_user_date ON receipts (user_id, date, status, category, vendor_key, month, amount);
+CREATE INDEX IF NOT EXISTS receipts_user_created ON receipts (user_id, created_at);
+"""
+UPSERT = "INSERT OR REPLACE INTO receipts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _row(doc_id: str, data: dict) -> tuple:
+    date = str(data.get("date") or "")
+    if not _DATE.match(date):
+        date = None
+    try:
+        amount = float(data.get("amount"))
+    except (TypeError, ValueError):
+        amount = None
+    created_at = data.get("created_at")
+    return (
+        doc_id,
+        data.get("user_id"),
+        date,
+        date[:7] if date else None,
+        data.get("store"),
+        data.get("vendor_key"),
+        amount,
+        data.get("category") or "Uncategorized",
+        data.get("status"),
+        created_at.timestamp() if hasattr(created_at, "timestamp") else None,
+    )
+
+
+def _date_filter(start_date: str = None, end_date: str = None) -> tuple:
+    clauses, params = [], []
+    if start_date:
+        clauses.append("date >= ?")
+        params.append(start_date)
+    if end_date:
+        clauses.append("date <= ?")
+        params.append(end_date)
+    return "".join(f" AND {clause}" for clause in clauses), params
+
+
+class AnalyticsMirror:
+    """Receipts table kept in sync with Firestore; safe to query from any thread."""
+
+    def __init__(self, path: str = ":memory:", max_staleness: float = None, restart_interval: float = 30.0):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._db = None
+        self._watch = None
+        self._watch_started = None
+        self._loaded = False
+        # Set when a replacement listener's first snapshot must replace the table
+        self._reset = False
+        self.max_staleness = max_staleness
+        self.restart_interval = restart_interval
+        self._last_restart = 0.0
+        self.restarts = 0
+        self.changes = 0
+        self.last_sync = None
+        self.queries = 0
+        self._query_seconds = 0.0
+
+    # ─── Sync ───
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            if self._reset:
+                # The first snapshot re-adds every receipt, so drop what
+                # may have been deleted while no listener was running.
+                self._conn.execute("DELETE FROM receipts")
+                self._reset = False
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    self._conn.execute("DELETE FROM receipts WHERE id = ?", (change.document.id,))
+                else:
+                    self._conn.execute(UPSERT, _row(change.document.id, change.document.to_dict() or {}))
+            self.changes += len(changes)
+            self.last_sync = time.time()
+            self._loaded = True
+
+    def start(self, db):
+        """Subscribes to the receipts collection; the first snapshot is a full load."""
+        self._db = db
+        self._subscribe()
+
+    def _subscribe(self):
+        self._watch_started = time.time()
+        self._watch = self._db.collection("receipts").on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        self._db = None
+        if self._watch:
+            self._watch.unsubscribe()
+            self._watch = None
+        self._loaded = False
+
+    def _listening(self) -> bool:
+        if self._watch is None or not getattr(self._watch, "is_active", True):
+            return False
+        if self.max_staleness:
+            last = max(self.last_sync or 0.0, self._watch_started)
+            return time.time() - last <= self.max_staleness
+        return True
+
+    def _restart(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_restart < self.restart_interval:
+                return
+            self._last_restart = now
+            self._loaded = False
+            self._reset = True
+            watch, self._watch = self._watch, None
+        logger.warning("Receipts listener is inactive or stale, resubscribing")
+        if watch:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                logger.warning(f"Could not close the old receipts listener: {e}")
+        self.restarts += 1
+        try:
+            self._subscribe()
+        except Exception as e:
+            logger.error(f"Could not resubscribe to receipts: {e}")
+
+    @property
+    def ready(self) -> bool:
+        """True while the mirror is loaded and, if it is listening, in sync."""
+        if self._db is None:
+            return self._loaded
+        if self._listening():
+            return self._loaded
+        self._restart()
+        return False
+
+    def rebuild(self, db, page_size: int = 1000) -> int:
+        """Reloads every receipt with a paginated scan; returns the count."""
+        with self._lock:
+            self._conn.execute("DELETE FROM receipts")
+        query = db.collection("receipts").order_by("__name__").limit(page_size)
+        count = 0
+        cursor = None
+        while True:
+            docs = list((query.start_after(cursor) if cursor else query).stream())
+            with self._lock:
+                self._conn.executemany(UPSERT, [_row(doc.id, doc.to_dict() or {}) for doc in docs])
+            count += len(docs)
+            if len(docs) < page_size:
+                break
+            cursor = docs[-1]
+        self.last_sync = time.time()
+        self._loaded = True
+        return count
+
+    # ─── Queries ───
+
+    def _query(self, sql: str, params) -> list:
+        start = time.perf_counter()
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        self.queries += 1
+        self._query_seconds += time.perf_counter() - start
+        return rows
+
+    def summary(self, user_id: str, start_date: str = None, end_date: str = None) -> dict:
+        """Same result as rollups.summarize, computed from the mirrored receipts."""
+        dates, date_params = _date_filter(start_date, end_date)
+        statuses = ", ".join("?" * len(COUNTED_STATUSES))
+        rows = self._query(
+            "SELECT category, SUM(amount), COUNT(*) FROM receipts"
+            f" WHERE user_id = ? AND status IN ({statuses}) AND date IS NOT NULL AND amount IS NOT NULL{dates}"
+            " GROUP BY category",
+            [user_id, *sorted(COUNTED_STATUSES), *date_params],
+        )
+        return {
+            "total_spent": round(sum(total for _, total, _ in rows), 2),
+            "by_category": {category: round(total, 2) for category, total, _ in rows if total},
+            "receipt_count": sum(count for _, _, count in rows),
+        }
+
+    def recent(self, user_id: str, limit: int = 5) -> dict:
+        """Same result as the bot's recent-receipts Firestore query."""
+        rows = self._query(
+            "SELECT store, date, amount, category FROM receipts"
+            " WHERE user_id = ? AND created_at IS NOT NULL ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        )
+        return {"receipts": [
+            {
+                "store": store or "Unknown",
+                "date": date or "N/A",
+                "amount": amount or 0.0,
+                "category": category,
+            }
+            for store, date, amount, category in rows
+        ]}
+
+    def group_by(
+        self, user_id: str, dimensions: list, start_date: str = None, end_date: str = None
+    ) -> list:
+        """Counted spending grouped by any of category, month and vendor."""
+        columns = [DIMENSIONS[dimension] for dimension in dimensions]
+        select = "".join(f"{column}, " for column in columns)
+        group = f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}" if columns else ""
+        dates, date_params = _date_filter(start_date, end_date)
+        statuses = ", ".join("?" * len(COUNTED_STATUSES))
+        rows = self._query(
+            f"SELECT {select}ROUND(SUM(amount), 2), COUNT(*) FROM receipts"
+            f" WHERE user_id = ? AND status IN ({statuses}) AND date IS NOT NULL AND amount IS NOT NULL{dates}"
+            f"{group}",
+            [user_id, *sorted(COUNTED_STATUSES), *date_params],
+        )
+        keys = [*dimensions, "total", "count"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            (size,) = self._conn.execute("SELECT COUNT(*) FROM receipts").fetchone()
+        return {
+            "ready": self.ready,
+            "restarts": self.restarts,
+            "receipts": size,
+            "changes_applied": self.changes,
+            "last_sync": self.last_sync,
+            "queries": self.queries,
+            "avg_query_ms": round(self._query_seconds / self.queries * 1000, 3) if self.queries else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    from google.cloud import firestore
+
+    parser = argparse.ArgumentParser(description="Spending report from a fresh receipts mirror.")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--group-by", default="category", help="comma-separated: category, month, vendor")
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    args = parser.parse_args()
+
+    mirror = AnalyticsMirror()
+    loaded = mirror.rebuild(firestore.Client())
+    print(f"Loaded {loaded} receipts")
+    dimensions = [d for d in args.group_by.split(",") if d]
+    print(json.dumps(mirror.group_by(args.user, dimensions, args.start, args.end), indent=2))
+    print(json.dumps(mirror.stats(), indent=2))
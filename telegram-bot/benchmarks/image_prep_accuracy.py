@@ -0,0 +1,109 @@
+"""Extraction accuracy and payload size: original vs. preprocessed images.
+
+Sends every receipt image in a directory to Gemini twice, once as-is and
+once after image_prep.preprocess, and compares the extracted store, date
+and amount. With a labels file the two runs are scored against ground
+truth; without one, the preprocessed run is scored against the original.
+
+    python benchmarks/image_prep_accuracy.py receipts/ [--labels labels.json]
+
+labels.json maps file names to {"store": ..., "date": ..., "amount": ...}.
+Uses the same Vertex AI project, model and prompt as the bot.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vertexai.generative_models import Part  # noqa: E402
+
+from bot import RECEIPT_PROMPT, model  # noqa: E402
+from image_prep import preprocess  # noqa: E402
+from vendors import normalize_vendor  # noqa: E402
+
+FIELDS = ("store", "date", "amount")
+
+
+def extract(image_bytes: bytes) -> tuple:
+    start = time.perf_counter()
+    response = model.generate_content([
+        RECEIPT_PROMPT, Part.from_data(data=image_bytes, mime_type="image/jpeg")
+    ])
+    elapsed = time.perf_counter() - start
+    text = response.text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1].rsplit("```", 1)[0].strip()
+    try:
+        return json.loads(text), elapsed
+    except json.JSONDecodeError:
+        return {}, elapsed
+
+
+def same(field: str, a, b) -> bool:
+    if field == "amount":
+        try:
+            return abs(float(a) - float(b)) < 0.005
+        except (TypeError, ValueError):
+            return False
+    if field == "store":
+        return normalize_vendor(a) == normalize_vendor(b)
+    return str(a or "").strip() == str(b or "").strip()
+
+
+def main(args):
+    labels = {}
+    if args.labels:
+        with open(args.labels) as f:
+            labels = json.load(f)
+
+    names = sorted(
+        name for name in os.listdir(args.directory)
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+    )
+    totals = {"original": [0, 0.0, 0], "prepared": [0, 0.0, 0]}
+    correct = {variant: {field: 0 for field in FIELDS} for variant in totals}
+
+    for name in names:
+        with open(os.path.join(args.directory, name), "rb") as f:
+            original = f.read()
+        variants = {"original": original, "prepared": preprocess(original)}
+        results = {}
+        for variant, data in variants.items():
+            results[variant], elapsed = extract(data)
+            totals[variant][0] += len(data)
+            totals[variant][1] += elapsed
+            totals[variant][2] += 1
+
+        truth = labels.get(name, results["original"])
+        for variant, result in results.items():
+            for field in FIELDS:
+                correct[variant][field] += same(field, result.get(field), truth.get(field))
+
+        print(
+            f"{name}: {len(variants['original']) // 1024}KB -> {len(variants['prepared']) // 1024}KB  "
+            + "  ".join(
+                f"{field}={'ok' if same(field, results['prepared'].get(field), truth.get(field)) else 'MISS'}"
+                for field in FIELDS
+            )
+        )
+
+    if not names:
+        print("No images found")
+        return
+
+    reference = "labels" if labels else "original"
+    print(f"\n{'variant':>9}  {'avg KB':>7}  {'avg s':>6}  " + "  ".join(f"{f:>7}" for f in FIELDS) + f"   (vs {reference})")
+    for variant, (size, seconds, count) in totals.items():
+        accuracy = "  ".join(f"{correct[variant][f] / count:>7.1%}" for f in FIELDS)
+        print(f"{variant:>9}  {size / count / 1024:>7.1f}  {seconds / count:>6.2f}  {accuracy}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--labels")
+    main(parser.parse_args())
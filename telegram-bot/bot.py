@@ -1,17 +1,33 @@
+import io
 import os
 import json
+import asyncio
 import logging
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-import hashlib
 
 import firebase_admin
 from firebase_admin import firestore
-from flask import Flask, request, jsonify
+from fastapi import FastAPI, Request, Response
 from telegram import Update, Bot
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, Image, Tool, FunctionDeclaration
 
+from analytics_mirror import AnalyticsMirror
+from categorizer import categorize
+from chat_engine import ChatEngine
+from extraction_cache import ExtractionCache, image_key, is_cacheable
+from fingerprint import record_new_receipts, record_receipt
+from image_prep import pick_photo_size, prepare_image
+from link_cache import LinkCache, bump_link_generation
+from query_cache import QueryCache, bump_generation
+from rollups import summarize
+from update_queue import UpdateQueue
+from vendors import VendorTable
+
 # ─── Config ───
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,12 +35,56 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator")
 REGION = os.environ.get("GOOGLE_CLOUD_REGION", "us-central1")
+# Keep-alive connections to api.telegram.org shared by all in-flight updates
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "32"))
+# Set with setWebhook(secret_token=...) so forged updates can be rejected
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", "1000"))
+# Cloud Run allows 10s between SIGTERM and SIGKILL
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("DRAIN_TIMEOUT_SECONDS", "8"))
+# Photos sharing a media_group_id within this window are handled as one album
+ALBUM_WINDOW_SECONDS = float(os.environ.get("ALBUM_WINDOW_SECONDS", "1.5"))
 
 # ─── Init Firebase ───
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 db = firestore.client()
 
+# Chat ID -> Firebase UID, so linked chats skip the telegram_links read
+link_cache = LinkCache(
+    db,
+    ttl=float(os.environ.get("LINK_CACHE_TTL_SECONDS", "600")),
+    max_size=int(os.environ.get("LINK_CACHE_MAX_ENTRIES", "10000")),
+    check_interval=float(os.environ.get("LINK_CACHE_CHECK_SECONDS", "5")),
+)
+
+# Chat tool results per user, invalidated whenever the user's receipts change
+query_cache = QueryCache(
+    db,
+    ttl=float(os.environ.get("QUERY_CACHE_TTL_SECONDS", "300")),
+    max_size=int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "5000")),
+)
+
+# Local SQL copy of all receipts for the chat tools, synced by a Firestore listener
+analytics_mirror = (
+    AnalyticsMirror(
+        os.environ.get("ANALYTICS_MIRROR_PATH", ":memory:"),
+        max_staleness=float(os.environ.get("ANALYTICS_MIRROR_MAX_STALENESS", "0")) or None,
+    )
+    if os.environ.get("ANALYTICS_MIRROR") == "1" else None
+)
+
+# Canonical vendor keys for raw store names
+vendors = VendorTable(db)
+
+# Previously extracted receipts, keyed on the image hash
+extraction_cache = ExtractionCache(
+    db,
+    ttl=float(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600))),
+    max_size=int(os.environ.get("EXTRACTION_CACHE_MAX_ENTRIES", "1024")),
+)
+
 # ─── Init Vertex AI / Gemini ───
 vertexai.init(project=PROJECT_ID, location=REGION)
 
@@ -63,8 +123,43 @@ get_recent_receipts_tool = FunctionDeclaration(
 tools = Tool(function_declarations=[get_spending_summary_tool, get_recent_receipts_tool])
 model = GenerativeModel("gemini-2.5-flash", tools=[tools])
 
-# ─── Flask App ───
-app = Flask(__name__)
+# ─── App ───
+# One Bot (and its pooled HTTP client) for the lifetime of the process,
+# instead of a new Bot and event loop per update.
+bot: Bot = None
+update_queue: UpdateQueue = None
+
+# Telegram re-sends an update until the webhook answers; remember recent IDs
+_recent_update_ids = set()
+_recent_update_order = deque(maxlen=2048)
+
+# media_group_id -> (queue reservation, album photo updates still being collected)
+_albums = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global bot, update_queue
+    bot = Bot(
+        token=TELEGRAM_TOKEN,
+        request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE),
+    )
+    await bot.initialize()
+    update_queue = UpdateQueue(process_update, UPDATE_WORKERS, MAX_PENDING_UPDATES)
+    update_queue.start()
+    if analytics_mirror:
+        analytics_mirror.start(db)
+    logger.info(f"Telegram bot ready (pool size {TELEGRAM_POOL_SIZE}, {UPDATE_WORKERS} workers)")
+    yield
+    for group_id in list(_albums):
+        _flush_album(group_id)
+    await update_queue.drain(DRAIN_TIMEOUT_SECONDS)
+    if analytics_mirror:
+        analytics_mirror.stop()
+    await bot.shutdown()
+
+
+app = FastAPI(title="Blue Hills Tax Bot", lifespan=lifespan)
 
 RECEIPT_PROMPT = """You are a tax specialist. Analyze this image.
 If it is clearly NOT a receipt, invoice, or tax-related document (e.g., a selfie, a cat, a landscape), respond ONLY with this JSON:
@@ -103,42 +198,21 @@ Keep responses concise (2-3 sentences max).
 User message: {message}"""
 
 def get_spending_summary_db(firebase_uid: str, start_date: str = None, end_date: str = None) -> dict:
-    """Queries Firestore for spending summary."""
+    """Builds a spending summary from the analytics mirror or the user's monthly rollups."""
     try:
-        query = db.collection('receipts').where('user_id', '==', firebase_uid)
-        if start_date:
-            query = query.where('date', '>=', start_date)
-        if end_date:
-            query = query.where('date', '<=', end_date)
-            
-        docs = query.stream()
-        
-        total = 0
-        by_category = {}
-        count = 0
-        
-        for doc in docs:
-            data = doc.to_dict()
-            amount = float(data.get('amount', 0))
-            category = data.get('category', 'Uncategorized')
-            
-            total += amount
-            by_category[category] = by_category.get(category, 0) + amount
-            count += 1
-            
-        return {
-            "total_spent": total,
-            "by_category": by_category,
-            "receipt_count": count
-        }
+        if analytics_mirror and analytics_mirror.ready:
+            return analytics_mirror.summary(firebase_uid, start_date, end_date)
+        return summarize(db, firebase_uid, start_date, end_date)
     except Exception as e:
         logger.error(f"Error in get_spending_summary_db: {e}")
         return {"error": str(e)}
 
 def get_recent_receipts_db(firebase_uid: str, limit: int = 5) -> dict:
-    """Queries Firestore for recent receipts."""
+    """Queries the analytics mirror, or Firestore, for recent receipts."""
     try:
         limit = min(max(1, limit), 20)  # Clamp between 1 and 20
+        if analytics_mirror and analytics_mirror.ready:
+            return analytics_mirror.recent(firebase_uid, limit)
         docs = db.collection('receipts') \
             .where('user_id', '==', firebase_uid) \
             .order_by('created_at', direction=firestore.Query.DESCENDING) \
@@ -161,75 +235,186 @@ def get_recent_receipts_db(firebase_uid: str, limit: int = 5) -> dict:
         return {"error": str(e)}
 
 
-def categorize(description: str) -> str:
-    """Same logic as tools.py tax_categorizer."""
-    desc = description.lower()
-    if any(k in desc for k in ['gas', 'fuel', 'oil change', 'car wash']):
-        return "Auto Expenses"
-    elif any(k in desc for k in ['meal', 'lunch', 'dinner', 'restaurant', 'coffee']):
-        return "Meals"
-    elif any(k in desc for k in ['hotel', 'flight', 'airbnb', 'uber', 'lyft']):
-        return "Travel"
-    elif any(k in desc for k in ['laptop', 'monitor', 'keyboard', 'mouse', 'software', 'office']):
-        return "Office Supplies"
-    elif any(k in desc for k in ['internet', 'phone', 'utility', 'electricity']):
-        return "Utilities"
-    elif any(k in desc for k in ['legal', 'consulting', 'accounting']):
-        return "Professional Services"
-    return "Uncategorized"
+def _clean_receipt(data: dict):
+    """Returns the extracted receipt with a numeric amount, or None if it has no usable amount."""
+    amount = data.get('amount')
+    if isinstance(amount, str):
+        amount = amount.replace('$', '').replace(',', '').strip()
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return None
+    return {
+        **data,
+        'store': data.get('store') or 'Unknown',
+        'date': data.get('date') or datetime.now().strftime('%Y-%m-%d'),
+        'amount': amount,
+        'category': data.get('category') or 'Uncategorized',
+    }
 
 
-def store_receipt(data: dict, telegram_user: str, firebase_uid: str) -> str:
-    """Store receipt to Firestore using deterministic ID to prevent duplicates."""
-    store = data.get('store', 'Unknown')
-    date = data.get('date', datetime.now().strftime('%Y-%m-%d'))
-    amount = float(data.get('amount', 0))
-    
-    unique_string = f"{store.strip().lower()}_{date.strip()}_{amount}"
-    doc_id = hashlib.md5(unique_string.encode('utf-8')).hexdigest()
-    
-    doc_ref = db.collection('receipts').document(doc_id)
-    if doc_ref.get().exists:
-        raise ValueError("duplicate_receipt")
-        
-    doc_ref.set({
+def _receipt_entry(data: dict, telegram_user: str, firebase_uid: str) -> tuple:
+    """Builds the (ref, user, vendor_key, date, amount, fields) tuple for a cleaned receipt."""
+    store = data['store']
+    date = data['date']
+    amount = data['amount']
+    vendor_key = vendors.canonical(store)
+
+    doc_ref = db.collection('receipts').document()
+    return doc_ref, firebase_uid, vendor_key, date, amount, {
         'store': store,
+        'vendor_key': vendor_key,
         'date': date,
         'amount': amount,
-        'category': data.get('category', 'Uncategorized'),
+        'category': data['category'],
         'description': data.get('description', ''),
         'source': 'telegram',
         'telegram_user': telegram_user,
         'user_id': firebase_uid,
         'status': 'processed' if amount < 500 else 'needs_approval',
         'created_at': firestore.SERVER_TIMESTAMP,
-    })
+    }
+
+
+def _receipts_changed(firebase_uid: str):
+    """Invalidates cached tool results for the user, here and on other instances."""
+    query_cache.invalidate_user(firebase_uid)
+    try:
+        bump_generation(db, firebase_uid)
+    except Exception as e:
+        logger.error(f"Failed to bump query generation for {firebase_uid}: {e}")
+
+
+def store_receipt(data: dict, telegram_user: str, firebase_uid: str) -> str:
+    """Store receipt to Firestore, claiming its fingerprint to prevent duplicates."""
+    doc_ref, *rest = _receipt_entry(data, telegram_user, firebase_uid)
+    duplicate_id = record_receipt(db, doc_ref, *rest, create=True)
+    if duplicate_id:
+        raise ValueError("duplicate_receipt")
+    _receipts_changed(firebase_uid)
     return doc_ref.id
 
 
-async def handle_photo(update: Update, bot: Bot):
-    """Process a receipt photo."""
-    chat_id = str(update.message.chat_id)
-    user = update.message.from_user
-    username = user.username or user.first_name or "Unknown"
+def store_receipts(receipts: list, telegram_user: str, firebase_uid: str) -> list:
+    """Stores several receipts in one transaction.
 
-    link_doc = db.collection("telegram_links").document(chat_id).get()
-    if not link_doc.exists:
-        await bot.send_message(chat_id, "⚠️ Please link your account first by typing `/link <code>` from your web dashboard.", parse_mode=ParseMode.MARKDOWN)
-        return
-    firebase_uid = link_doc.to_dict()["firebase_uid"]
+    Returns, per receipt, its new document ID or None if it is a duplicate.
+    """
+    entries = [_receipt_entry(data, telegram_user, firebase_uid) for data in receipts]
+    duplicates = record_new_receipts(db, entries)
+    if not all(duplicates):
+        _receipts_changed(firebase_uid)
+    return [
+        None if duplicate_id else entry[0].id
+        for entry, duplicate_id in zip(entries, duplicates)
+    ]
 
-    await bot.send_message(chat_id, "📸 Got your receipt! Analyzing with Gemini AI...")
 
+def _cached_call(tool: str, fn, firebase_uid: str, args: dict) -> dict:
+    # The mirror answers faster than the cache's generation read
+    if analytics_mirror and analytics_mirror.ready:
+        return fn(firebase_uid, **args)
     try:
-        # Download the photo (highest resolution)
-        photo = update.message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        photo_bytes = await file.download_as_bytearray()
+        result, generation = query_cache.get(firebase_uid, tool, args)
+    except Exception as e:
+        logger.warning(f"Query cache lookup for {tool} failed, calling uncached: {e}")
+        return fn(firebase_uid, **args)
+    if result is None:
+        result = fn(firebase_uid, **args)
+        try:
+            query_cache.put(firebase_uid, tool, args, generation, result)
+        except Exception as e:
+            logger.warning(f"Query cache store for {tool} failed: {e}")
+    return result
+
+
+async def _spending_summary_tool(firebase_uid: str, args: dict) -> dict:
+    args = {"start_date": args.get("start_date"), "end_date": args.get("end_date")}
+    return await asyncio.to_thread(
+        _cached_call, "get_spending_summary", get_spending_summary_db, firebase_uid, args
+    )
+
+
+async def _recent_receipts_tool(firebase_uid: str, args: dict) -> dict:
+    args = {"limit": int(args.get("limit", 5))}
+    return await asyncio.to_thread(
+        _cached_call, "get_recent_receipts", get_recent_receipts_db, firebase_uid, args
+    )
+
+
+chat_engine = ChatEngine(
+    model,
+    {
+        "get_spending_summary": _spending_summary_tool,
+        "get_recent_receipts": _recent_receipts_tool,
+    },
+    max_rounds=int(os.environ.get("MAX_TOOL_ROUNDS", "3")),
+)
+
 
+def link_account(chat_id: str, code: str) -> bool:
+    """Links a Telegram chat to the Firebase user who issued `code`."""
+    doc_ref = db.collection("link_codes").document(code)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return False
+    data = doc.to_dict()
+    link_cache.invalidate(chat_id)
+    db.collection("telegram_links").document(chat_id).set({
+        "firebase_uid": data["firebase_uid"],
+        "created_at": firestore.SERVER_TIMESTAMP
+    })
+    doc_ref.delete()
+    try:
+        bump_link_generation(db)
+    except Exception as e:
+        logger.error(f"Failed to bump link generation for chat {chat_id}: {e}")
+    link_cache.put(chat_id, data["firebase_uid"], link_cache.generation)
+    return True
+
+
+def _fetch_link(chat_id: str):
+    link_doc = db.collection("telegram_links").document(chat_id).get()
+    return link_doc.to_dict()["firebase_uid"] if link_doc.exists else None
+
+
+async def get_linked_uid(chat_id: str):
+    """Returns the Firebase UID linked to a chat, or None if it is not linked."""
+    if link_cache.check_due():
+        try:
+            await asyncio.to_thread(link_cache.refresh)
+        except Exception as e:
+            logger.warning(f"Link generation check failed: {e}")
+    firebase_uid = link_cache.get(chat_id)
+    if firebase_uid is None:
+        generation = link_cache.generation
+        firebase_uid = await asyncio.to_thread(_fetch_link, chat_id)
+        if firebase_uid:
+            link_cache.put(chat_id, firebase_uid, generation)
+    return firebase_uid
+
+
+async def extract_receipt(bot: Bot, photo_sizes) -> dict:
+    """Downloads a photo and returns its extracted receipt data.
+
+    Raises json.JSONDecodeError if Gemini's answer is not valid JSON.
+    """
+    # Download the smallest photo size that is still large enough to read
+    photo = pick_photo_size(photo_sizes)
+    file = await bot.get_file(photo.file_id)
+    photo_buffer = io.BytesIO()
+    await file.download_to_memory(out=photo_buffer)
+
+    # Re-sent photos reuse the earlier extraction
+    cache_key = image_key(photo_buffer.getbuffer())
+    data = await asyncio.to_thread(extraction_cache.get, cache_key)
+    if data is not None:
+        logger.info(f"Extraction cache hit for {cache_key[:12]}")
+    else:
         # Send to Gemini Vision via Vertex AI
-        image_part = Part.from_data(data=bytes(photo_bytes), mime_type="image/jpeg")
-        response = model.generate_content([RECEIPT_PROMPT, image_part])
+        image_bytes = await asyncio.to_thread(prepare_image, photo_buffer)
+        image_part = Part.from_data(data=image_bytes, mime_type="image/jpeg")
+        response = await model.generate_content_async([RECEIPT_PROMPT, image_part])
 
         # Parse the JSON response
         text = response.text.strip()
@@ -237,6 +422,30 @@ async def handle_photo(update: Update, bot: Bot):
             text = text.split("\n", 1)[1].rsplit("```", 1)[0].strip()
 
         data = json.loads(text)
+        if is_cacheable(data):
+            await asyncio.to_thread(extraction_cache.put, cache_key, data)
+
+    # Double-check category
+    if data.get('category') == 'Uncategorized' and data.get('description'):
+        data['category'] = categorize(data['description'])
+    return data
+
+
+async def handle_photo(update: Update, bot: Bot):
+    """Process a receipt photo."""
+    chat_id = str(update.message.chat_id)
+    user = update.message.from_user
+    username = user.username or user.first_name or "Unknown"
+
+    firebase_uid = await get_linked_uid(chat_id)
+    if not firebase_uid:
+        await bot.send_message(chat_id, "⚠️ Please link your account first by typing `/link <code>` from your web dashboard.", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    await bot.send_message(chat_id, "📸 Got your receipt! Analyzing with Gemini AI...")
+
+    try:
+        data = await extract_receipt(bot, update.message.photo)
 
         if data.get("error") == "not_tax_document":
             await bot.send_message(
@@ -245,15 +454,19 @@ async def handle_photo(update: Update, bot: Bot):
             )
             return
 
-        # Double-check category
-        if data.get('category') == 'Uncategorized' and data.get('description'):
-            data['category'] = categorize(data['description'])
+        data = _clean_receipt(data)
+        if data is None:
+            await bot.send_message(
+                chat_id,
+                "⚠️ I couldn't read the total on this receipt. Make sure the amount is visible and try again!"
+            )
+            return
 
         # Store to Firestore
-        doc_id = store_receipt(data, username, firebase_uid)
+        doc_id = await asyncio.to_thread(store_receipt, data, username, firebase_uid)
 
         # Format response
-        amount = float(data.get('amount', 0))
+        amount = data['amount']
         status = "⚠️ Needs Approval (>$500)" if amount >= 500 else "✅ Processed"
 
         reply = (
@@ -268,6 +481,12 @@ async def handle_photo(update: Update, bot: Bot):
         )
         await bot.send_message(chat_id, reply, parse_mode=ParseMode.MARKDOWN_V2)
 
+    except json.JSONDecodeError:
+        await bot.send_message(
+            chat_id,
+            "⚠️ I could see the image but couldn't extract receipt data. "
+            "Make sure the receipt is clearly visible and try again!"
+        )
     except ValueError as e:
         if str(e) == "duplicate_receipt":
             await bot.send_message(
@@ -276,12 +495,6 @@ async def handle_photo(update: Update, bot: Bot):
             )
             return
         raise
-    except json.JSONDecodeError:
-        await bot.send_message(
-            chat_id,
-            "⚠️ I could see the image but couldn't extract receipt data. "
-            "Make sure the receipt is clearly visible and try again!"
-        )
     except Exception as e:
         logger.error(f"Error processing photo: {e}", exc_info=True)
         await bot.send_message(
@@ -290,6 +503,67 @@ async def handle_photo(update: Update, bot: Bot):
         )
 
 
+async def handle_album(updates: list, bot: Bot):
+    """Process a Telegram album of receipt photos with a single reply."""
+    message = updates[0].message
+    chat_id = str(message.chat_id)
+    user = message.from_user
+    username = user.username or user.first_name or "Unknown"
+
+    firebase_uid = await get_linked_uid(chat_id)
+    if not firebase_uid:
+        await bot.send_message(chat_id, "⚠️ Please link your account first by typing `/link <code>` from your web dashboard.", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    await bot.send_message(chat_id, f"📸 Got {len(updates)} receipts! Analyzing with Gemini AI...")
+
+    results = await asyncio.gather(
+        *(extract_receipt(bot, update.message.photo) for update in updates),
+        return_exceptions=True,
+    )
+
+    lines = {}
+    to_store = []
+    for index, result in enumerate(results, 1):
+        if isinstance(result, json.JSONDecodeError):
+            lines[index] = "⚠️ Couldn't read this one"
+        elif isinstance(result, Exception):
+            logger.error(f"Error processing album photo {index}: {result}", exc_info=result)
+            lines[index] = "❌ Error processing receipt"
+        elif result.get("error") == "not_tax_document":
+            lines[index] = "⚠️ Not a receipt"
+        elif (cleaned := _clean_receipt(result)) is None:
+            lines[index] = f"⚠️ {result.get('store') or 'Unknown'} · couldn't read the amount"
+        else:
+            to_store.append((index, cleaned))
+
+    total = 0.0
+    saved = 0
+    if to_store:
+        try:
+            doc_ids = await asyncio.to_thread(store_receipts, [data for _, data in to_store], username, firebase_uid)
+        except Exception as e:
+            logger.error(f"Error storing album: {e}", exc_info=True)
+            doc_ids = [e] * len(to_store)
+        for (index, data), doc_id in zip(to_store, doc_ids):
+            amount = data['amount']
+            summary = f"{data['store']} · ${amount:.2f} · {data['category']}"
+            if isinstance(doc_id, Exception):
+                lines[index] = f"❌ {summary} (not saved)"
+            elif doc_id is None:
+                lines[index] = f"⚠️ {summary} (duplicate)"
+            else:
+                saved += 1
+                total += amount
+                lines[index] = f"{'⚠️' if amount >= 500 else '✅'} {summary}"
+
+    reply = (
+        f"*🧾 {saved} of {len(updates)} receipts saved \\(${_escape(f'{total:.2f}')}\\)*\n\n"
+        + "\n".join(f"{index}\\. {_escape(lines[index])}" for index in sorted(lines))
+    )
+    await bot.send_message(chat_id, reply, parse_mode=ParseMode.MARKDOWN_V2)
+
+
 async def handle_text(update: Update, bot: Bot):
     """Handle text messages."""
     chat_id = str(update.message.chat_id)
@@ -297,15 +571,7 @@ async def handle_text(update: Update, bot: Bot):
 
     if text.startswith("/link "):
         code = text.split(" ")[1].strip()
-        doc_ref = db.collection("link_codes").document(code)
-        doc = doc_ref.get()
-        if doc.exists:
-            data = doc.to_dict()
-            db.collection("telegram_links").document(chat_id).set({
-                "firebase_uid": data["firebase_uid"],
-                "created_at": firestore.SERVER_TIMESTAMP
-            })
-            doc_ref.delete()
+        if await asyncio.to_thread(link_account, chat_id, code):
             await bot.send_message(chat_id, "✅ Account successfully linked! You can now send receipts.")
         else:
             await bot.send_message(chat_id, "❌ Invalid or expired linking code.")
@@ -338,48 +604,16 @@ async def handle_text(update: Update, bot: Bot):
         return
 
     # User must be linked to use AI text
-    link_doc = db.collection("telegram_links").document(chat_id).get()
-    if not link_doc.exists:
+    firebase_uid = await get_linked_uid(chat_id)
+    if not firebase_uid:
         text_reply = "⚠️ Please link your account first by typing `/link <code>` from your web dashboard."
         await bot.send_message(chat_id, text_reply, parse_mode=ParseMode.MARKDOWN)
         return
 
     # Use Gemini for text responses
     try:
-        chat = model.start_chat()
-        response = chat.send_message(TEXT_PROMPT.format(message=text))
-
-        # Handle tool calls if any
-        if response.function_calls:
-            for function_call in response.function_calls:
-                func_name = function_call.name
-                args = function_call.args
-                firebase_uid = link_doc.to_dict()["firebase_uid"]
-
-                api_response = {}
-                if func_name == "get_spending_summary":
-                    api_response = get_spending_summary_db(
-                        firebase_uid, 
-                        args.get("start_date"), 
-                        args.get("end_date")
-                    )
-                elif func_name == "get_recent_receipts":
-                    api_response = get_recent_receipts_db(
-                        firebase_uid, 
-                        args.get("limit", 5)
-                    )
-                else:
-                    api_response = {"error": f"Unknown function: {func_name}"}
-
-                # Send function response back to Gemini to get the final answer
-                response = chat.send_message(
-                    Part.from_function_response(
-                        name=func_name,
-                        response={"content": api_response}
-                    )
-                )
-
-        await bot.send_message(chat_id, response.text)
+        reply, _ = await chat_engine.reply(TEXT_PROMPT.format(message=text), firebase_uid)
+        await bot.send_message(chat_id, reply)
     except Exception as e:
         logger.error(f"Error handling text: {e}")
         await bot.send_message(chat_id, "Sorry, I couldn't process that. Try sending a receipt photo! 📸")
@@ -393,43 +627,118 @@ def _escape(text: str) -> str:
 
 
 # ─── Webhook Endpoint ───
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    """Handle incoming Telegram webhook updates."""
-    import asyncio
-    data = request.get_json()
-    logger.info(f"Received update: {json.dumps(data)[:200]}")
+async def process_update(update):
+    if isinstance(update, list):
+        await handle_album(update, bot)
+    elif update.message:
+        if update.message.photo:
+            await handle_photo(update, bot)
+        elif update.message.text:
+            await handle_text(update, bot)
+
+
+def _collect_album(update: Update) -> bool:
+    """Holds an album photo until the rest of its media group has arrived.
+
+    The first photo reserves the album's place in the update queue, so
+    the album keeps its position in the chat. Returns False if the queue
+    has no room for it.
+    """
+    group_id = update.message.media_group_id
+    if group_id in _albums:
+        _albums[group_id][1].append(update)
+        return True
+    reservation = update_queue.reserve(str(update.message.chat_id))
+    if reservation is None:
+        return False
+    _albums[group_id] = (reservation, [update])
+    asyncio.get_running_loop().call_later(ALBUM_WINDOW_SECONDS, _flush_album, group_id)
+    return True
+
+
+def _flush_album(group_id: str):
+    album = _albums.pop(group_id, None)
+    if not album:
+        return
+    reservation, updates = album
+    updates.sort(key=lambda u: u.message.message_id)
+    update_queue.fill(reservation, updates)
+
+
+def _seen_update(update_id: int) -> bool:
+    if update_id in _recent_update_ids:
+        return True
+    if len(_recent_update_order) == _recent_update_order.maxlen:
+        _recent_update_ids.discard(_recent_update_order[0])
+    _recent_update_order.append(update_id)
+    _recent_update_ids.add(update_id)
+    return False
 
-    async def process_update():
-        async with Bot(token=TELEGRAM_TOKEN) as bot:
-            update = Update.de_json(data, bot)
-            if update.message:
-                if update.message.photo:
-                    await handle_photo(update, bot)
-                elif update.message.text:
-                    await handle_text(update, bot)
 
+def _forget_update(update_id: int):
+    """Undoes `_seen_update` so Telegram's retry of the update is accepted."""
+    _recent_update_ids.discard(update_id)
     try:
-        asyncio.run(process_update())
-    except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
+        _recent_update_order.remove(update_id)
+    except ValueError:
+        pass
 
-    return jsonify({"ok": True})
 
+@app.post("/webhook")
+async def webhook(request: Request):
+    """Validate and queue a Telegram update; processing happens in the background."""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        logger.warning("Rejected webhook call with a bad secret token")
+        return Response(status_code=403)
 
-@app.route("/health", methods=["GET"])
-def health():
-    return jsonify({"status": "healthy", "service": "telegram-bot"})
+    try:
+        data = await request.json()
+        update = Update.de_json(data, bot)
+    except Exception as e:
+        logger.error(f"Malformed update: {e}")
+        return {"ok": True}
+    logger.info(f"Received update: {json.dumps(data)[:200]}")
+
+    if not update.message or _seen_update(update.update_id):
+        return {"ok": True}
+
+    if update.message.photo and update.message.media_group_id:
+        queued = _collect_album(update)
+    else:
+        queued = update_queue.submit(str(update.message.chat_id), update)
+    if not queued:
+        # Let Telegram retry later rather than dropping the message
+        logger.warning(f"Update queue full ({update_queue.depth}), asking Telegram to retry")
+        _forget_update(update.update_id)
+        return Response(status_code=503)
+
+    return {"ok": True}
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "healthy",
+        "service": "telegram-bot",
+        "extraction_cache": extraction_cache.stats(),
+        "update_queue": update_queue.stats() if update_queue else None,
+        "link_cache": link_cache.stats(),
+        "query_cache": query_cache.stats(),
+        "analytics_mirror": analytics_mirror.stats() if analytics_mirror else None,
+        "chat": chat_engine.stats(),
+    }
 
 
-@app.route("/", methods=["GET"])
-def index():
-    return jsonify({
+@app.get("/")
+async def index():
+    return {
         "service": "Blue Hills Tax Bot (Telegram)",
         "status": "running",
-    })
+    }
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port)
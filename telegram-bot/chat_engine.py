@@ -0,0 +1,110 @@
+"""Async Gemini chat loop with concurrent function calling.
+
+Uses the async Vertex AI APIs so a conversation waiting on Gemini does not
+hold up other chats. When Gemini asks for several functions in one
+response they run concurrently, and their results go back in a single
+message. Gemini may ask for more tools after seeing results, up to
+`max_rounds` times. Calls beyond that get an error result telling Gemini to
+answer with what it already has, and if it still returns no text the
+user gets FALLBACK_TEXT.
+"""
+
+import asyncio
+import logging
+import time
+
+from vertexai.generative_models import GenerativeModel, Part
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_TEXT = "Sorry, I couldn't finish looking that up. Try asking something more specific."
+LIMIT_RESULT = {"error": "Tool call limit reached. Answer using the results you already have."}
+
+
+def _text(response) -> str:
+    """The response's text, or FALLBACK_TEXT if it has none (e.g. only function calls)."""
+    try:
+        return response.text or FALLBACK_TEXT
+    except ValueError:
+        return FALLBACK_TEXT
+
+
+class ChatEngine:
+    """Runs one user turn against `model` with the given tool handlers.
+
+    `tools` maps function names to coroutines taking `(firebase_uid, args)`
+    and returning a JSON-serializable dict.
+    """
+
+    def __init__(self, model: GenerativeModel, tools: dict, max_rounds: int = 3):
+        self.model = model
+        self.tools = tools
+        self.max_rounds = max_rounds
+        self.totals = {"turns": 0, "rounds": 0, "tool_calls": 0, "model_seconds": 0.0, "tool_seconds": 0.0, "total_seconds": 0.0}
+
+    async def _call(self, function_call, firebase_uid: str) -> dict:
+        handler = self.tools.get(function_call.name)
+        if handler is None:
+            return {"error": f"Unknown function: {function_call.name}"}
+        try:
+            return await handler(firebase_uid, dict(function_call.args))
+        except Exception as e:
+            logger.error(f"Tool {function_call.name} failed: {e}", exc_info=True)
+            return {"error": str(e)}
+
+    async def reply(self, prompt: str, firebase_uid: str) -> tuple:
+        """Returns Gemini's final text answer and timing stats for the turn."""
+        started = time.perf_counter()
+        stats = {"rounds": 0, "tool_calls": 0, "model_seconds": 0.0, "tool_seconds": 0.0}
+
+        try:
+            chat = self.model.start_chat()
+            t = time.perf_counter()
+            response = await chat.send_message_async(prompt)
+            stats["model_seconds"] += time.perf_counter() - t
+
+            while response.function_calls:
+                function_calls = response.function_calls
+                if stats["rounds"] >= self.max_rounds:
+                    logger.warning(f"Stopping after {self.max_rounds} tool rounds")
+                    results = [LIMIT_RESULT] * len(function_calls)
+                else:
+                    stats["rounds"] += 1
+                    stats["tool_calls"] += len(function_calls)
+                    t = time.perf_counter()
+                    results = await asyncio.gather(
+                        *(self._call(function_call, firebase_uid) for function_call in function_calls)
+                    )
+                    stats["tool_seconds"] += time.perf_counter() - t
+
+                t = time.perf_counter()
+                response = await chat.send_message_async([
+                    Part.from_function_response(name=function_call.name, response={"content": result})
+                    for function_call, result in zip(function_calls, results)
+                ])
+                stats["model_seconds"] += time.perf_counter() - t
+                if results[0] is LIMIT_RESULT:
+                    break
+
+            return _text(response), stats
+        finally:
+            stats["total_seconds"] = time.perf_counter() - started
+            self.totals["turns"] += 1
+            for key, value in stats.items():
+                self.totals[key] += value
+            logger.info(
+                f"Chat turn: {stats['rounds']} tool rounds, {stats['tool_calls']} calls, "
+                f"model {stats['model_seconds']:.2f}s, tools {stats['tool_seconds']:.2f}s, "
+                f"total {stats['total_seconds']:.2f}s"
+            )
+
+    def stats(self) -> dict:
+        turns = self.totals["turns"]
+        return {
+            "turns": turns,
+            "tool_calls": self.totals["tool_calls"],
+            "avg_rounds": round(self.totals["rounds"] / turns, 2) if turns else 0.0,
+            "avg_model_ms": round(self.totals["model_seconds"] / turns * 1000, 1) if turns else 0.0,
+            "avg_tool_ms": round(self.totals["tool_seconds"] / turns * 1000, 1) if turns else 0.0,
+            "avg_turn_ms": round(self.totals["total_seconds"] / turns * 1000, 1) if turns else 0.0,
+        }
@@ -0,0 +1,155 @@
+"""Content-addressed cache of receipt extractions.
+
+Keyed on the SHA-256 of the image bytes, so the same photo re-sent from
+Telegram or re-uploaded through the dashboard skips the Gemini call.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_COLLECTION = "extraction_cache"
+EXTRACTION_FIELDS = ("store", "date", "amount", "category", "description")
+
+
+def image_key(image_bytes) -> str:
+    """Returns the cache key for an image (bytes, bytearray or memoryview)."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def is_cacheable(data: dict) -> bool:
+    """Only complete extractions are worth replaying."""
+    return bool(data) and not data.get("error") and data.get("amount") is not None and bool(data.get("date"))
+
+
+class ExtractionCache:
+    """Two-tier extraction cache: an in-process LRU in front of Firestore.
+
+    Entries expire after `ttl` seconds in both tiers. The Firestore documents
+    carry an `expires_at` timestamp so a Firestore TTL policy can purge them.
+    Pass `db=None` to use the local tier only. With a sync Firestore client use
+    `get`/`put`; with an AsyncClient use `aget`/`aput`. Safe to share
+    between threads.
+    """
+
+    def __init__(self, db=None, ttl: float = 30 * 24 * 3600, max_size: int = 1024):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    def _get_local(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def _put_local(self, key: str, data: dict, ttl: float = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (ttl or self.ttl), data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _from_remote(self, key: str, doc) -> Optional[dict]:
+        if doc is None or not doc.exists:
+            return None
+        entry = doc.to_dict()
+        remaining = (entry["expires_at"] - datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0:
+            return None
+        data = {k: entry[k] for k in EXTRACTION_FIELDS if k in entry}
+        self._put_local(key, data, ttl=remaining)
+        with self._lock:
+            self.remote_hits += 1
+        return data
+
+    def _to_remote(self, data: dict) -> dict:
+        return {
+            **data,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+        }
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns the cached extraction for `key`, or None on a miss."""
+        data = self._get_local(key)
+        if data is None and self.db is not None:
+            try:
+                doc = self.db.collection(CACHE_COLLECTION).document(key).get()
+            except Exception as e:
+                logger.warning(f"Extraction cache lookup failed: {e}")
+                doc = None
+            data = self._from_remote(key, doc)
+        return self._count(data)
+
+    async def aget(self, key: str) -> Optional[dict]:
+        """Like `get`, for caches backed by a Firestore AsyncClient."""
+        data = self._get_local(key)
+        if data is None and self.db is not None:
+            try:
+                doc = await self.db.collection(CACHE_COLLECTION).document(key).get()
+            except Exception as e:
+                logger.warning(f"Extraction cache lookup failed: {e}")
+                doc = None
+            data = self._from_remote(key, doc)
+        return self._count(data)
+
+    def _count(self, data: Optional[dict]) -> Optional[dict]:
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dict(data)
+
+    def put(self, key: str, data: dict):
+        """Stores an extraction; incomplete or error results are ignored."""
+        if not is_cacheable(data):
+            return
+        data = {k: data[k] for k in EXTRACTION_FIELDS if k in data}
+        self._put_local(key, data)
+
+        if self.db is not None:
+            try:
+                self.db.collection(CACHE_COLLECTION).document(key).set(self._to_remote(data))
+            except Exception as e:
+                logger.warning(f"Extraction cache write failed: {e}")
+
+    async def aput(self, key: str, data: dict):
+        """Like `put`, for caches backed by a Firestore AsyncClient."""
+        if not is_cacheable(data):
+            return
+        data = {k: data[k] for k in EXTRACTION_FIELDS if k in data}
+        self._put_local(key, data)
+
+        if self.db is not None:
+            try:
+                await self.db.collection(CACHE_COLLECTION).document(key).set(self._to_remote(data))
+            except Exception as e:
+                logger.warning(f"Extraction cache write failed: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,118 @@
+"""In-process cache of Telegram chat -> Firebase user links.
+
+Links almost never change, so authenticated messages can skip the
+`telegram_links` read. Only existing links are cached: an unlinked chat is
+looked up again each time so a `/link` handled by another instance is seen
+straight away.
+
+A re-link handled by another instance is picked up through a generation
+counter in `link_generations`, which every link write bumps. The cache
+reads it at most once per `check_interval` seconds and drops all its
+entries when it has moved, so a changed link is served for at most that
+long instead of for the whole TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from google.cloud import firestore
+
+GENERATION_COLLECTION = "link_generations"
+GENERATION_DOC = "all"
+
+
+def bump_link_generation(db: firestore.Client):
+    """Tells every instance's LinkCache that a link has changed."""
+    db.collection(GENERATION_COLLECTION).document(GENERATION_DOC).set(
+        {"generation": firestore.Increment(1)}, merge=True
+    )
+
+
+def get_link_generation(db: firestore.Client) -> int:
+    doc = db.collection(GENERATION_COLLECTION).document(GENERATION_DOC).get()
+    return (doc.to_dict() or {}).get("generation", 0) if doc.exists else 0
+
+
+class LinkCache:
+    """TTL + LRU map from chat ID to Firebase UID, with hit-rate counters.
+
+    Pass `db` to follow the link generation; call `refresh` (off the event
+    loop, it reads Firestore) whenever `check_due` returns True. Safe to use
+    from worker threads.
+    """
+
+    def __init__(self, db=None, ttl: float = 600.0, max_size: int = 10000, check_interval: float = 5.0):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def check_due(self) -> bool:
+        """Returns True, at most once per `check_interval`, when the generation should be read."""
+        if self.db is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_check:
+                return False
+            self._next_check = now + self.check_interval
+            return True
+
+    def refresh(self):
+        """Reads the link generation and drops every entry if it has moved."""
+        generation = get_link_generation(self.db)
+        with self._lock:
+            if self.generation is not None and generation != self.generation:
+                self._entries.clear()
+                self.flushes += 1
+            self.generation = generation
+
+    def get(self, chat_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(chat_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[chat_id]
+            self.misses += 1
+            return None
+
+    def put(self, chat_id: str, firebase_uid: str, generation: int = None):
+        """Caches a link read while `generation` was current.
+
+        A link read before the last flush may already be outdated, so it is
+        not cached.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[chat_id] = (time.monotonic() + self.ttl, firebase_uid)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: str):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "generation": self.generation,
+            "flushes": self.flushes,
+        }
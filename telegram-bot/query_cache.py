@@ -0,0 +1,107 @@
+"""Per-user cache of chat tool results, invalidated by receipt writes.
+
+Each user has a generation counter in the `query_generations` collection.
+Every receipt write made for the user by the bot or the tax automator bumps
+it. A cached result is only served while the generation it was computed at
+is still current, so reading one small document replaces the rollup or
+receipt queries behind the tool. Writes made outside those paths, such as
+approvals from the web app, are picked up once the TTL expires.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud import firestore
+
+GENERATION_COLLECTION = "query_generations"
+
+
+def _generation_ref(db, user_id: str):
+    return db.collection(GENERATION_COLLECTION).document(user_id)
+
+
+def bump_generation(db: firestore.Client, user_id: str):
+    """Invalidates every cached tool result for `user_id`."""
+    _generation_ref(db, user_id).set({"generation": firestore.Increment(1)}, merge=True)
+
+
+async def abump_generation(db: firestore.AsyncClient, user_id: str):
+    await _generation_ref(db, user_id).set({"generation": firestore.Increment(1)}, merge=True)
+
+
+def get_generation(db: firestore.Client, user_id: str) -> int:
+    doc = _generation_ref(db, user_id).get()
+    return (doc.to_dict() or {}).get("generation", 0) if doc.exists else 0
+
+
+class QueryCache:
+    """LRU of (user, tool, args) -> result, tagged with the user's generation.
+
+    Safe to use from the worker threads the sync Firestore calls run on.
+    """
+
+    def __init__(self, db: firestore.Client, ttl: float = 300.0, max_size: int = 5000):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(user_id: str, tool: str, args: dict) -> tuple:
+        return (user_id, tool, json.dumps(args, sort_keys=True, default=str))
+
+    def get(self, user_id: str, tool: str, args: dict) -> tuple:
+        """Returns (result or None, current generation).
+
+        Pass the generation back to `put` so a result computed while a
+        write landed is tagged with the older generation and never served.
+        """
+        generation = get_generation(self.db, user_id)
+        key = self._key(user_id, tool, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entry_generation, result = entry
+                if entry_generation == generation and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result, generation
+                del self._entries[key]
+                self.stale += 1
+            self.misses += 1
+        return None, generation
+
+    def put(self, user_id: str, tool: str, args: dict, generation: int, result: dict):
+        if "error" in result:
+            return
+        key = self._key(user_id, tool, args)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, generation, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: str):
+        """Drops the user's entries after a write made by this process."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,250 @@
+"""Pre-aggregated spending rollups.
+
+One document per user and month in `spending_rollups` holds the month's
+total and count, the same split by category, and a per-day breakdown for
+date ranges that start or end mid-month:
+
+    {user_id, month: "2025-01", total, count,
+     categories: {category: {total, count}},
+     days: {"15": {category: {total, count}}}}
+
+Every receipt write goes through a transaction that applies the difference
+between the receipt's old and new contribution, so re-processing or a
+status change never double counts. A spending summary then reads a handful
+of monthly documents instead of every receipt. `rebuild_rollups` recomputes
+them from the raw receipts, one user per transaction. It is a manual
+backfill, run once when rollups are introduced or after receipts are
+deleted from the dashboard:
+
+    python rollups.py [--user UID]
+"""
+
+import re
+from typing import Optional
+
+from google.cloud import firestore
+
+ROLLUP_COLLECTION = "spending_rollups"
+# Receipt statuses that count as spending
+COUNTED_STATUSES = {"processed", "needs_approval", "approved", "completed"}
+
+_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _contribution(data: Optional[dict]):
+    """Returns (user_id, month, day, category, amount) or None if not counted."""
+    if not data or data.get("status") not in COUNTED_STATUSES or not data.get("user_id"):
+        return None
+    date = str(data.get("date") or "")
+    if not _DATE.match(date):
+        return None
+    try:
+        amount = float(data.get("amount"))
+    except (TypeError, ValueError):
+        return None
+    category = data.get("category") or "Uncategorized"
+    return data["user_id"], date[:7], date[8:10], category, amount
+
+
+def _bucket(docs: dict, user_id: str, month: str) -> dict:
+    return docs.setdefault(f"{user_id}_{month}", {
+        "user_id": user_id,
+        "month": month,
+        "total": 0.0,
+        "count": 0,
+        "categories": {},
+        "days": {},
+    })
+
+
+def _add(doc: dict, day: str, category: str, total: float, count: int):
+    doc["total"] += total
+    doc["count"] += count
+    cat = doc["categories"].setdefault(category, {"total": 0.0, "count": 0})
+    cat["total"] += total
+    cat["count"] += count
+    day_cat = doc["days"].setdefault(day, {}).setdefault(category, {"total": 0.0, "count": 0})
+    day_cat["total"] += total
+    day_cat["count"] += count
+
+
+def _as_increments(value):
+    if isinstance(value, dict):
+        return {k: _as_increments(v) for k, v in value.items()}
+    if isinstance(value, (int, float)):
+        return firestore.Increment(value)
+    return value
+
+
+def rollup_deltas(old: Optional[dict], new: Optional[dict]) -> dict:
+    """Maps rollup doc IDs to the increments turning `old` into `new`."""
+    return rollup_deltas_many([(old, new)])
+
+
+def rollup_deltas_many(changes) -> dict:
+    """Like `rollup_deltas` for several (old, new) receipt changes at once.
+
+    Changes hitting the same month are merged, since a transaction may only
+    write each rollup document once.
+    """
+    deltas = {}
+    for old, new in changes:
+        for sign, data in ((-1, old), (1, new)):
+            contribution = _contribution(data)
+            if contribution:
+                user_id, month, day, category, amount = contribution
+                key = (user_id, month, day, category)
+                total, count = deltas.get(key, (0.0, 0))
+                deltas[key] = (total + sign * amount, count + sign)
+
+    docs = {}
+    for (user_id, month, day, category), (total, count) in deltas.items():
+        if total == 0 and count == 0:
+            continue
+        _add(_bucket(docs, user_id, month), day, category, total, count)
+    return docs
+
+
+def apply_rollup(transaction, db, old: Optional[dict], new: Optional[dict]):
+    """Adds the rollup writes for a receipt change to `transaction`."""
+    apply_rollups(transaction, db, [(old, new)])
+
+
+def apply_rollups(transaction, db, changes):
+    """Adds the rollup writes for several (old, new) receipt changes."""
+    for doc_id, fields in rollup_deltas_many(changes).items():
+        fields = _as_increments(fields)
+        fields["updated_at"] = firestore.SERVER_TIMESTAMP
+        transaction.set(db.collection(ROLLUP_COLLECTION).document(doc_id), fields, merge=True)
+
+
+def update_receipt_tracked(db: firestore.Client, receipt_ref, fields: dict):
+    """Updates a receipt and its rollup in one transaction."""
+
+    @firestore.transactional
+    def _update(transaction):
+        snapshot = receipt_ref.get(transaction=transaction)
+        old = snapshot.to_dict() if snapshot.exists else None
+        transaction.update(receipt_ref, fields)
+        apply_rollup(transaction, db, old, {**(old or {}), **fields})
+
+    _update(db.transaction())
+
+
+async def aupdate_receipt_tracked(db: firestore.AsyncClient, receipt_ref, fields: dict):
+    """Like `update_receipt_tracked`, for a Firestore AsyncClient."""
+
+    @firestore.async_transactional
+    async def _update(transaction):
+        snapshot = await receipt_ref.get(transaction=transaction)
+        old = snapshot.to_dict() if snapshot.exists else None
+        transaction.update(receipt_ref, fields)
+        apply_rollup(transaction, db, old, {**(old or {}), **fields})
+
+    await _update(db.transaction())
+
+
+def merge_rollups(rollups, start_date: str = None, end_date: str = None) -> dict:
+    """Combines monthly rollup dicts into a spending summary for a date range."""
+    total = 0.0
+    count = 0
+    by_category = {}
+
+    def add(category, stats):
+        nonlocal total, count
+        total += stats.get("total", 0)
+        count += stats.get("count", 0)
+        by_category[category] = by_category.get(category, 0) + stats.get("total", 0)
+
+    for rollup in rollups:
+        month = rollup["month"]
+        first_day = f"{month}-01"
+        last_day = f"{month}-31"
+        whole_month = (not start_date or start_date <= first_day) and (not end_date or end_date >= last_day)
+        if whole_month:
+            for category, stats in rollup.get("categories", {}).items():
+                add(category, stats)
+            continue
+        for day, categories in rollup.get("days", {}).items():
+            date = f"{month}-{day}"
+            if (start_date and date < start_date) or (end_date and date > end_date):
+                continue
+            for category, stats in categories.items():
+                add(category, stats)
+
+    return {
+        "total_spent": round(total, 2),
+        "by_category": {k: round(v, 2) for k, v in by_category.items() if v},
+        "receipt_count": count,
+    }
+
+
+def _rollup_query(db, user_id: str, start_date: str = None, end_date: str = None):
+    query = db.collection(ROLLUP_COLLECTION).where("user_id", "==", user_id)
+    if start_date:
+        query = query.where("month", ">=", start_date[:7])
+    if end_date:
+        query = query.where("month", "<=", end_date[:7])
+    return query
+
+
+def summarize(db: firestore.Client, user_id: str, start_date: str = None, end_date: str = None) -> dict:
+    """Spending summary for a user and optional inclusive YYYY-MM-DD range."""
+    docs = _rollup_query(db, user_id, start_date, end_date).stream()
+    return merge_rollups((doc.to_dict() for doc in docs), start_date, end_date)
+
+
+def rebuild_user_rollups(db: firestore.Client, user_id: str) -> int:
+    """Recomputes one user's rollups in a transaction; returns the number written.
+
+    The user's receipts and rollups are read inside the transaction, so a
+    receipt write landing meanwhile makes it retry instead of being lost or
+    counted twice.
+    """
+
+    @firestore.transactional
+    def _rebuild(transaction):
+        docs = {}
+        receipts = db.collection("receipts").where("user_id", "==", user_id)
+        for doc in transaction.get(receipts):
+            contribution = _contribution(doc.to_dict())
+            if contribution:
+                _, month, day, category, amount = contribution
+                _add(_bucket(docs, user_id, month), day, category, amount, 1)
+
+        existing = list(transaction.get(_rollup_query(db, user_id)))
+        for snapshot in existing:
+            if snapshot.id not in docs:
+                transaction.delete(snapshot.reference)
+        for doc_id, fields in docs.items():
+            transaction.set(db.collection(ROLLUP_COLLECTION).document(doc_id), {
+                **fields, "updated_at": firestore.SERVER_TIMESTAMP,
+            })
+        return len(docs)
+
+    return _rebuild(db.transaction())
+
+
+def rebuild_rollups(db: firestore.Client, user_id: str = None) -> int:
+    """Recomputes rollups for one user or every user; returns the number written."""
+    if user_id:
+        return rebuild_user_rollups(db, user_id)
+    user_ids = set()
+    for collection in ("receipts", ROLLUP_COLLECTION):
+        for doc in db.collection(collection).select(["user_id"]).stream():
+            uid = (doc.to_dict() or {}).get("user_id")
+            if uid:
+                user_ids.add(uid)
+    return sum(rebuild_user_rollups(db, uid) for uid in sorted(user_ids))
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Rebuild spending rollups from receipts.")
+    parser.add_argument("--user", help="Only rebuild this Firebase UID")
+    args = parser.parse_args()
+
+    client = firestore.Client(project=os.environ.get("GOOGLE_CLOUD_PROJECT", "blue-hills-tax-automator"))
+    print(f"Rebuilt {rebuild_rollups(client, args.user)} rollup documents")
@@ -0,0 +1,152 @@
+"""Background processing queue for Telegram updates.
+
+The webhook only validates and enqueues; a fixed pool of workers does the
+slow part (photo download, Gemini, Firestore). Updates from the same chat
+are handled one at a time in arrival order, while different chats proceed
+in parallel.
+
+Work whose content is not known yet (an album still being collected) can
+`reserve` its place first. The reservation holds queue capacity and the
+chat's position, and later updates from that chat wait behind it until
+`fill` supplies the item.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Reservation:
+    """A place in a chat's queue, held until `UpdateQueue.fill` gives it an item."""
+
+    __slots__ = ("chat_id", "enqueued_at", "item", "filled")
+
+    def __init__(self, chat_id: str, item=None, filled: bool = False):
+        self.chat_id = chat_id
+        self.enqueued_at = time.monotonic()
+        self.item = item
+        self.filled = filled
+
+
+class UpdateQueue:
+    """Bounded, per-chat-ordered work queue drained by `workers` tasks."""
+
+    def __init__(self, handler, workers: int = 8, max_pending: int = 1000):
+        self._handler = handler
+        self._workers_count = workers
+        self.max_pending = max_pending
+        self._pending = {}
+        # Chats whose next entry is a reservation that has not been filled
+        self._parked = set()
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = []
+        self._accepting = False
+
+        self.depth = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+
+    def start(self):
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._workers_count)
+        ]
+
+    def submit(self, chat_id: str, item) -> bool:
+        """Queues `item` behind earlier work for the same chat.
+
+        Returns False if the queue is full or shutting down.
+        """
+        return self._append(Reservation(chat_id, item, filled=True)) is not None
+
+    def reserve(self, chat_id: str):
+        """Holds a place behind earlier work for the same chat.
+
+        Returns a Reservation to pass to `fill`, or None if the queue is
+        full or shutting down.
+        """
+        return self._append(Reservation(chat_id))
+
+    def fill(self, reservation: Reservation, item):
+        """Supplies the item for a reservation, releasing the chat's queue."""
+        reservation.item = item
+        reservation.filled = True
+        chat_id = reservation.chat_id
+        if chat_id in self._parked and self._pending[chat_id][0] is reservation:
+            self._parked.discard(chat_id)
+            self._ready.put_nowait(chat_id)
+
+    def _append(self, entry: Reservation):
+        if not self._accepting or self.depth >= self.max_pending:
+            self.rejected += 1
+            return None
+
+        queue = self._pending.get(entry.chat_id)
+        if queue is None:
+            queue = self._pending[entry.chat_id] = deque()
+            # The chat has no worker on it yet, so schedule it.
+            self._schedule(entry.chat_id, entry)
+        queue.append(entry)
+
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._idle.clear()
+        return entry
+
+    def _schedule(self, chat_id: str, head: Reservation):
+        if head.filled:
+            self._ready.put_nowait(chat_id)
+        else:
+            self._parked.add(chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._pending[chat_id]
+            entry = queue.popleft()
+            self._total_wait += time.monotonic() - entry.enqueued_at
+            try:
+                await self._handler(entry.item)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Update for chat {chat_id} failed: {e}", exc_info=True)
+            finally:
+                self.processed += 1
+                self.depth -= 1
+                if queue:
+                    self._schedule(chat_id, queue[0])
+                else:
+                    del self._pending[chat_id]
+                if self.depth == 0:
+                    self._idle.set()
+
+    async def drain(self, timeout: float):
+        """Stops accepting updates and waits up to `timeout` for the backlog."""
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {self.depth} updates still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "active_chats": len(self._pending),
+            "workers": self._workers_count,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._total_wait / self.processed * 1000, 1) if self.processed else 0.0,
+        }
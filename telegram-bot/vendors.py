@@ -0,0 +1,141 @@
+"""Vendor name canonicalization.
+
+Turns the free-form `store` string Gemini extracts ("Starbucks #1234",
+"STARBUCKS COFFEE") into a stable `vendor_key` ("starbucks") in three
+steps:
+
+1. Normalization rules: lowercase, drop store numbers, punctuation and
+   corporate suffixes.
+2. Alias lookup: the normalized name is looked up in the built-in
+   vendor_aliases.json and then in the `vendor_aliases` Firestore
+   collection, which can be extended without a deploy.
+3. An in-process LRU remembers the result for `ttl` seconds, so repeat
+   vendors cost nothing and new Firestore aliases are picked up within
+   that time.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+ALIAS_COLLECTION = "vendor_aliases"
+ALIASES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor_aliases.json")
+UNKNOWN_VENDOR = "unknown vendor"
+
+_STORE_NUMBER = re.compile(r"(?:#\s*\d+|\b(?:store|unit|location|loc|no)\.?\s*#?\s*\d+\b)")
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_TRAILING_DIGITS = re.compile(r"(?:\s+\d+)+$")
+_CORPORATE_SUFFIXES = {"inc", "llc", "ltd", "co", "corp", "corporation", "company", "plc", "gmbh"}
+
+
+@lru_cache(maxsize=4096)
+def normalize_vendor(store: str) -> str:
+    """Applies the normalization rules; does not consult any alias table."""
+    name = (store or "").lower()
+    name = _STORE_NUMBER.sub(" ", name)
+    name = name.replace("&", " and ").replace("'", "")
+    name = _NON_ALNUM.sub(" ", name).strip()
+    name = _TRAILING_DIGITS.sub("", name)
+
+    words = name.split()
+    if words and words[0] == "the" and len(words) > 1:
+        words = words[1:]
+    while len(words) > 1 and words[-1] in _CORPORATE_SUFFIXES:
+        words.pop()
+    return " ".join(words) or UNKNOWN_VENDOR
+
+
+def _load_builtin_aliases(path: str = ALIASES_PATH) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+class VendorTable:
+    """Resolves store names to canonical vendor keys.
+
+    Pass a sync Firestore client and use `canonical`, or an AsyncClient and
+    use `acanonical`. With `db=None` only the built-in aliases are used.
+    Safe to share between threads.
+    """
+
+    def __init__(self, db=None, max_size: int = 4096, ttl: float = 600.0):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.builtin = _load_builtin_aliases()
+        self._lru: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, normalized: str):
+        with self._lock:
+            entry = self._lru.get(normalized)
+            if entry is not None and entry[0] > time.monotonic():
+                self._lru.move_to_end(normalized)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._lru[normalized]
+            self.misses += 1
+            return None
+
+    def _remember(self, normalized: str, canonical: str) -> str:
+        with self._lock:
+            self._lru[normalized] = (time.monotonic() + self.ttl, canonical)
+            self._lru.move_to_end(normalized)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+        return canonical
+
+    def _from_doc(self, normalized: str, doc) -> str:
+        if doc is not None and doc.exists:
+            return doc.get("canonical")
+        return self.builtin.get(normalized, normalized)
+
+    def canonical(self, store: str) -> str:
+        normalized = normalize_vendor(store)
+        canonical = self._cached(normalized)
+        if canonical is not None:
+            return canonical
+
+        doc = None
+        if self.db is not None:
+            try:
+                doc = self.db.collection(ALIAS_COLLECTION).document(normalized).get()
+            except Exception as e:
+                logger.warning(f"Vendor alias lookup failed: {e}")
+        return self._remember(normalized, self._from_doc(normalized, doc))
+
+    async def acanonical(self, store: str) -> str:
+        normalized = normalize_vendor(store)
+        canonical = self._cached(normalized)
+        if canonical is not None:
+            return canonical
+
+        doc = None
+        if self.db is not None:
+            try:
+                doc = await self.db.collection(ALIAS_COLLECTION).document(normalized).get()
+            except Exception as e:
+                logger.warning(f"Vendor alias lookup failed: {e}")
+        return self._remember(normalized, self._from_doc(normalized, doc))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._lru),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }